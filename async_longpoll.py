@@ -1,37 +1,30 @@
-import requests
-import random
+import logging
 import redis
-import json
-import aiohttp
+import redis.asyncio
 import asyncio
 
-from pprint import pprint
+from functools import partial
 from environs import Env
 from textwrap import dedent
-from time import sleep
 from asgiref.sync import sync_to_async
-from more_itertools import chunked
 
-from buttons import get_start_buttons, get_menu_button, get_course_buttons
+from batcher import ExecuteBatcher
+from buttons import get_start_buttons, get_menu_button
+from catalog import CourseCatalog
+from checkpoint import SeenEvents, TsCheckpoint
+from dispatcher import Dispatcher
+from events import EVENT_TYPES, IncomingCallback, IncomingMessage, parse_event
+from longpoll_client import LongPollClient
+from metrics import HANDLER_SECONDS, REGISTRY, log_sampled, start_metrics_server, stats_collector
+from outbox import Outbox, event_scope, next_random_id
+from profiles import ProfileResolver
+from scheduler import OutboundScheduler, PRIORITY_INTERACTIVE
+from storage import AsyncStateStore, CachedStateStore, async_redis_from
+from transport import Transports
+from vk_api import call_method, is_rate_limit_error
 
 
-async def get_long_poll_server(session: aiohttp.ClientSession, token: str, group_id: int, /):
-    get_album_photos_url = 'https://api.vk.com/method/groups.getLongPollServer'
-    params = {'access_token': token, 'v': '5.131', 'group_id': group_id}
-    async with session.get(get_album_photos_url, params=params) as res:
-        res.raise_for_status()
-        response = json.loads(await res.text())
-        key = response['response']['key']
-        server = response['response']['server']
-        ts = response['response']['ts']
-        return key, server, ts
-
-
-async def connect_server(session: aiohttp.ClientSession, key, server, ts):
-    params = {'act': 'a_check', 'key': key, 'ts': ts, 'wait': 25}
-    async with session.get(server, params=params) as res:
-        res.raise_for_status()
-        return json.loads(await res.text())
+logger = logging.getLogger(__name__)
 
 
 async def send_message(
@@ -44,12 +37,11 @@ async def send_message(
         sticker_id: int = None,
         lat: str = None,
         long: str = None,
+        priority: int = PRIORITY_INTERACTIVE,
 ):
-    send_message_url = 'https://api.vk.com/method/messages.send'
     params = {
-        'access_token': connect['token'], 'v': '5.131',
         'user_id': user_id,
-        'random_id': random.randint(0, 1000),
+        'random_id': next_random_id(),
         'message': message,
         'attachment': attachment,
         'keyboard': keyboard,
@@ -58,40 +50,48 @@ async def send_message(
         'lat': lat,
         'long': long
     }
-    for param, value in params.copy().items():
-        if value is None:
-            del params[param]
-    async with connect['session'].post(send_message_url, params=params) as res:
-        print(await res.text())
-        res.raise_for_status()
-        return json.loads(await res.text())
+    if connect.get('outbox') is not None:
+        response = await connect['outbox'].send('messages.send', params, priority=priority)
+    else:
+        response = await call_method(connect, 'messages.send', params, priority=priority)
+    log_sampled(logger, 'messages.send', user_id=user_id, response=response)
+    return response
 
 
-async def get_user(connect, user_ids: str):
-    get_users_url = 'https://api.vk.com/method/users.get'
+async def edit_message(connect, peer_id: int, conversation_message_id: int, message: str, keyboard: str = None):
+    params = {
+        'peer_id': peer_id,
+        'conversation_message_id': conversation_message_id,
+        'message': message,
+        'keyboard': keyboard,
+    }
+    return await call_method(connect, 'messages.edit', params)
+
+
+async def send_message_event_answer(connect, callback: IncomingCallback, event_data: str = None):
     params = {
-        'access_token': connect['token'], 'v': '5.131',
-        'user_ids': user_ids
+        'event_id': callback.callback_id,
+        'user_id': callback.user_id,
+        'peer_id': callback.peer_id,
+        'event_data': event_data,
     }
-    async with connect['session'].get(get_users_url, params=params) as res:
-        res.raise_for_status()
-        response = json.loads(await res.text())
-        return response.get('response')
+    return await call_method(connect, 'messages.sendMessageEventAnswer', params)
+
 
+async def get_user(connect, user_ids: str):
+    return await call_method(connect, 'users.get', {'user_ids': user_ids})
 
-async def event_handler(connect, event):
+
+async def event_handler(connect, message: IncomingMessage):
     """Главный обработчик событий"""
 
-    user_id = event['object']['message']['from_id']
-    start_buttons = ['start', '/start', 'начать', 'старт', '+']
-    text = event['object']['message']['text'].lower().strip()
-    payload = json.loads(event['object']['message'].get('payload', '{}'))
-    if not connect['redis_db'].get(f'{user_id}_first_name'):
-        user_data = await get_user(connect, user_id)
-        if user_data:
-            connect['redis_db'].set(f'{user_id}_first_name', user_data[0].get('first_name'))
-            connect['redis_db'].set(f'{user_id}_last_name', user_data[0].get('last_name'))
-    if text in start_buttons or payload.get('button') == 'start':
+    user_id = message.user_id
+    stored_state, user_info = await connect['state_store'].load(user_id)
+    if user_info:
+        connect['profiles'].remember(user_id, user_info)
+    else:
+        await connect['profiles'].resolve(user_id)
+    if message.is_start:
         user_state = 'START'
         msg = f'''
             Привет, я бот этого чата.
@@ -106,99 +106,103 @@ async def event_handler(connect, event):
             keyboard=await get_menu_button(color='positive', inline=False)
         )
     else:
-        user_state = connect['redis_db'].get(user_id).decode("utf-8")
-        print(user_state)
-
-    states_functions = {
-        'START': start,
-        'MAIN_MENU': main_menu_handler,
-        # 'COURSE': handle_course_info,
-        # 'PHONE': enter_phone,
-    }
-    state_handler = states_functions[user_state]
-    next_state = await state_handler(connect, event)
-    connect['redis_db'].set(user_id, next_state)
+        user_state = stored_state or 'START'
+
+    state_handler = STATE_HANDLERS[user_state]
+    with HANDLER_SECONDS.time(state=user_state, group_id=connect['group_id']):
+        next_state = await state_handler(connect, message)
+    await connect['state_store'].save(user_id, next_state)
 
 
-async def start(connect, event):
-    user_id = event['object']['message']['from_id']
+async def start(connect, message: IncomingMessage):
     await send_message(
         connect,
-        user_id=user_id,
+        user_id=message.user_id,
         message='MENU:',
-        keyboard=await get_start_buttons()
+        keyboard=await get_start_buttons(callback=message.supports_callback)
     )
     return 'MAIN_MENU'
 
 
-async def main_menu_handler(connect, event):
-    payload = json.loads(event['object']['message'].get('payload', '{}'))
-    if payload:
-        return await send_main_menu_answer(connect, event)
+async def main_menu_handler(connect, message: IncomingMessage):
+    if message.payload:
+        return await send_main_menu_answer(connect, message)
     else:
-        print(event['object']['message']['text'])
-        # return answer_arbitrary_text(connect, event)
+        log_sampled(logger, 'arbitrary text', text=message.raw_text)
+        # return answer_arbitrary_text(connect, message)
     return 'START'
 
 
+# Обработчики состояний, собираются один раз при импорте
+STATE_HANDLERS = {
+    'START': start,
+    'MAIN_MENU': main_menu_handler,
+    # 'COURSE': handle_course_info,
+    # 'PHONE': enter_phone,
+}
+
+
 #######################################
 ## Функции, не являющиеся хэндлерами ##
 #######################################
-async def send_main_menu_answer(connect, event):
-    user_id = event['object']['message']['from_id']
-    payload = json.loads(event['object']['message'].get('payload', '{}'))
-    user_instance = await Client.objects.async_get(vk_id=user_id)
-    user_info = {
-        'first_name': connect['redid_db'].get(f'{user_id}_first_name').decode('utf-8'),
-        'last_name': connect['redid_db'].get(f'{user_id}_last_name').decode('utf-8')
-    }
-    # отправка курсов пользователя
-    if payload.get('button') == 'client_courses':
-        client_courses = await sync_to_async(user_instance.courses.filter)(published_in_bot=True)
-        return await send_courses(
-            connect, event, client_courses,
-            'Вы еше не записаны ни на один курс:',
-            'Курсы, на которые вы записаны или проходили:',
-            'Еще ваши курсы',
-            back='client_courses',
-        )
-    # отправка предстоящих курсов
-    elif payload.get('button') == 'future_courses':
-        future_courses = await Course.objects.async_filter(scheduled_at__gt=timezone.now(), published_in_bot=True)
-        return await send_courses(
-            connect, event, future_courses,
-            'Пока нет запланированных курсов:',
-            'Предстоящие курсы. Выберите для детальной информации',
-            'Еще предстоящие курсы:',
-            back='future_courses',
-        )
-    # отправка прошедших курсов
-    elif payload.get('button') == 'past_courses':
-        past_courses = await Course.objects.async_filter(scheduled_at__lte=timezone.now(), published_in_bot=True)
-        return await send_courses(
-            connect, event, past_courses,
-            'Еше нет прошедших курсов:',
-            'Прошедшие курсы',
-            'Еще прошедшие курсы:',
-            back='past_courses',
-        )
-    elif payload.get('button') == 'admin_msg':
-        user_msg = f'{user_info["first_name"]}, введите и отправьте ваше сообщение:'
+COURSE_MESSAGES = {
+    'client_courses': (
+        'Вы еше не записаны ни на один курс:',
+        'Курсы, на которые вы записаны или проходили:',
+        'Еще ваши курсы',
+    ),
+    'future_courses': (
+        'Пока нет запланированных курсов:',
+        'Предстоящие курсы. Выберите для детальной информации',
+        'Еще предстоящие курсы:',
+    ),
+    'past_courses': (
+        'Еше нет прошедших курсов:',
+        'Прошедшие курсы',
+        'Еще прошедшие курсы:',
+    ),
+}
+
+
+async def load_courses(section, user_id):
+    """Опубликованные курсы раздела из базы, вызывается только при перестройке CourseCatalog"""
+    # курсы пользователя
+    if section == 'client_courses':
+        user_instance = await Client.objects.async_get(vk_id=user_id)
+        courses = await sync_to_async(user_instance.courses.filter)(published_in_bot=True)
+    # предстоящие курсы
+    elif section == 'future_courses':
+        courses = await Course.objects.async_filter(scheduled_at__gt=timezone.now(), published_in_bot=True)
+    # прошедшие курсы
+    else:
+        courses = await Course.objects.async_filter(scheduled_at__lte=timezone.now(), published_in_bot=True)
+    return await sync_to_async(list)(courses)
+
+
+async def send_main_menu_answer(connect, message: IncomingMessage):
+    user_id = message.user_id
+    user_info = await connect['profiles'].resolve(user_id) or {}
+    # отправка курсов из кэша каталога
+    if message.button in COURSE_MESSAGES:
+        pages = await connect['catalog'].get_pages(message.button, user_id, callback=message.supports_callback)
+        return await send_courses(connect, message, pages, *COURSE_MESSAGES[message.button])
+    elif message.button == 'admin_msg':
+        user_msg = f'{user_info.get("first_name", "")}, введите и отправьте ваше сообщение:'
         await send_message(connect, user_id, message=user_msg)
 
 
-async def send_courses(connect, event, courses, msg1, msg2, msg3, /, *, back):
-    user_id = event['object']['message']['from_id']
-    i = 0
-    for client_courses_part in await sync_to_async(chunked)(courses, 5):
-        i += 1
-        msg = msg2 if i == 1 else msg3
-        keyboard = await get_course_buttons(client_courses_part, back=back)
+async def send_courses(connect, message: IncomingMessage, pages, msg1, msg2, msg3, /):
+    user_id = message.user_id
+    if message.supports_callback:
+        # остальные страницы открываются кнопками листания через messages.edit
+        pages = pages[:1]
+    for i, keyboard in enumerate(pages):
+        msg = msg2 if i == 0 else msg3
         await send_message(
             connect, user_id, message=msg,
             keyboard=keyboard
         )
-    if i == 0:
+    if not pages:
         await send_message(
             connect, user_id, message=msg1,
             keyboard=await get_menu_button(color='secondary', inline=True)
@@ -206,81 +210,269 @@ async def send_courses(connect, event, courses, msg1, msg2, msg3, /, *, back):
     return 'COURSE'
 
 
+async def callback_handler(connect, callback: IncomingCallback):
+    """
+    Нажатие callback-кнопки: меню и страницы курсов заменяются в том же
+    сообщении через messages.edit вместо отправки новых сообщений.
+    """
+    if callback.button in COURSE_MESSAGES:
+        pages = await connect['catalog'].get_pages(callback.button, callback.user_id, callback=True)
+        msg1, msg2, msg3 = COURSE_MESSAGES[callback.button]
+        if pages:
+            page = min(max(int(callback.payload.get('page', 0)), 0), len(pages) - 1)
+            text, keyboard = (msg2 if page == 0 else msg3), pages[page]
+        else:
+            text, keyboard = msg1, await get_menu_button(color='secondary', inline=True, callback=True)
+        next_state = 'COURSE'
+    elif callback.button == 'start':
+        text, keyboard = 'MENU:', await get_start_buttons(callback=True)
+        next_state = 'MAIN_MENU'
+    else:
+        await send_message_event_answer(connect, callback)
+        return
+    # оба вызова уходят одним execute
+    await asyncio.gather(
+        edit_message(connect, callback.peer_id, callback.conversation_message_id, text, keyboard),
+        send_message_event_answer(connect, callback),
+    )
+    await connect['state_store'].save(callback.user_id, next_state)
+
+
+EVENT_HANDLERS = {
+    IncomingMessage.type: event_handler,
+    IncomingCallback.type: callback_handler,
+}
+
+
+async def handle_update(connect, message):
+    """message - IncomingMessage или IncomingCallback"""
+    with event_scope(message.event_id):
+        await EVENT_HANDLERS[message.type](connect, message)
+    await connect['seen_events'].mark(message.event)
+
+
+async def process_updates(connect, dispatcher, checkpoint, events, ts):
+    """Раздает новые события воркерам и отмечает ts пачки для сохранения"""
+    events = [event for event in events if event.get('type') in EVENT_TYPES]
+    try:
+        events = await connect['seen_events'].filter_new(events)
+    except Exception as err:
+        # без Redis лучше ответить повторно, чем потерять пачку
+        logger.warning(f'Повторы событий не проверены: {err}')
+    futures = []
+    for event in events:
+        try:
+            message = parse_event(event)
+        except (KeyError, TypeError, ValueError) as err:
+            logger.warning(f'Событие {event.get("event_id")} не разобрано: {err!r}')
+            continue
+        futures.append(await dispatcher.dispatch(message.user_id, connect, message))
+    checkpoint.track(ts, futures)
+
+
+async def listen_updates(
+        connect,
+        dispatcher,
+        checkpoint,
+        client: LongPollClient,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+):
+    """Цикл long poll: ошибка обработки пачки логируется, и опрос продолжается после паузы"""
+    attempt = 0
+    async for events in client.listen():
+        log_sampled(logger, 'updates', count=len(events), ts=client.ts)
+        try:
+            await process_updates(connect, dispatcher, checkpoint, events, client.ts)
+        except Exception as err:
+            delay = min(backoff_max, backoff_base * 2 ** attempt)
+            attempt += 1
+            logger.exception(f'Пачка событий не обработана: {err}, продолжение через {delay:.1f} с')
+            await asyncio.sleep(delay)
+        else:
+            attempt = 0
+
+
+def register_collectors(connect, dispatcher, client):
+    """Публикует stats() очередей, кэшей и соединений в REGISTRY"""
+    register_shared_collectors(connect)
+    register_group_collectors(connect, dispatcher, client)
+
+
+def register_shared_collectors(connect):
+    """Общие для всех сообществ процесса очередь отправки и пул соединений"""
+    REGISTRY.add_collector(stats_collector('vk_send', connect['scheduler'].stats))
+    REGISTRY.add_collector(stats_collector('vk_http', connect['transports'].stats))
+
+
+def register_group_collectors(connect, dispatcher, client, **labels):
+    """
+    Очереди и кэши одного сообщества, labels добавляются ко всем метрикам.
+    Возвращает добавленные collectors, чтобы убрать их при перезапуске.
+    """
+    stats = [
+        ('vk_dispatcher', lambda: {'queued': dispatcher.qsize()}),
+        ('vk_profiles', connect['profiles'].stats),
+        ('vk_execute', connect['batcher'].stats),
+        ('vk_catalog', connect['catalog'].stats),
+    ]
+    if connect.get('outbox') is not None:
+        stats.append(('vk_outbox', connect['outbox'].stats))
+    if isinstance(connect['state_store'], CachedStateStore):
+        stats.append(('vk_state_cache', connect['state_store'].stats))
+    stats.append(('vk_longpoll', client.stats))
+    collectors = [stats_collector(prefix, group_stats, **labels) for prefix, group_stats in stats]
+    for collector in collectors:
+        REGISTRY.add_collector(collector)
+    return collectors
+
+
+def create_redis(env: Env) -> redis.asyncio.Redis:
+    return redis.asyncio.Redis(
+        host=env.str('REDIS_HOST'),
+        port=env.str('REDIS_PORT'),
+        password=env.str('REDIS_PASSWORD')
+    )
+
+
+def create_transports(env: Env) -> Transports:
+    return Transports(
+        api_limit=env.int('API_CONNECTIONS', 100),
+        dns_ttl=env.int('DNS_CACHE_TTL', 300)
+    )
+
+
+def connect_options(env: Env) -> dict:
+    return {
+        'send_rate': env.float('SEND_RATE', 20),
+        'send_queue_size': env.int('SEND_QUEUE_SIZE', 1000),
+        'execute_window': env.float('EXECUTE_WINDOW', 0.02),
+        'state_cache': env.str('STATE_CACHE', 'exclusive'),
+        'state_flush_interval': env.float('STATE_FLUSH_INTERVAL', 1),
+        'outbox': env.bool('OUTBOX', True),
+    }
+
+
+async def create_connect(
+        transports: Transports,
+        token: str,
+        redis_db: redis.asyncio.Redis,
+        group_id: int,
+        /, *,
+        send_rate: float = 20,
+        send_queue_size: int = 1000,
+        execute_window: float = 0.02,
+        state_cache: str = 'exclusive',
+        state_flush_interval: float = 1,
+        outbox: bool = True,
+        scheduler: OutboundScheduler = None,
+        state_prefix: str = '',
+):
+    """
+    Собирает connect: сессия API, Redis, очередь отправки, кэш состояний
+    и профилей и batcher execute.
+
+    state_cache - режим CachedStateStore (exclusive или shared),
+    'off' - состояния читаются и пишутся напрямую в Redis.
+    outbox - отправлять сообщения через Outbox с повторами.
+    scheduler - общая очередь отправки нескольких сообществ: тогда send_rate
+    задается ей как лимит для group_id, а close_connect ее не закрывает.
+    """
+    shared_scheduler = scheduler is not None
+    if shared_scheduler:
+        scheduler.set_rate(group_id, send_rate)
+    else:
+        scheduler = OutboundScheduler(rate=send_rate, queue_size=send_queue_size, retry_on=is_rate_limit_error)
+        await scheduler.start()
+    state_store = AsyncStateStore(redis_db, state_prefix)
+    if state_cache != 'off':
+        state_store = CachedStateStore(state_store, mode=state_cache, flush_interval=state_flush_interval)
+        await state_store.start()
+    connect = {
+        'session': transports.api, 'token': token, 'group_id': group_id,
+        'redis_db': redis_db, 'state_store': state_store,
+        'scheduler': scheduler, 'shared_scheduler': shared_scheduler, 'transports': transports
+    }
+    connect['profiles'] = ProfileResolver(partial(get_user, connect), connect['state_store'])
+    connect['batcher'] = ExecuteBatcher(connect, window=execute_window)
+    connect['seen_events'] = SeenEvents(redis_db, f'vk_longpoll:{group_id}:event:')
+    connect['catalog'] = CourseCatalog(load_courses, redis_db)
+    if outbox:
+        connect['outbox'] = Outbox(connect, f'vk_outbox:{group_id}')
+        await connect['outbox'].start()
+    return connect
+
+
+async def close_connect(connect):
+    """Дожидается отправки исходящих запросов и записывает несохраненные состояния"""
+    if connect.get('outbox') is not None:
+        await connect['outbox'].close()
+    if not connect['shared_scheduler']:
+        await connect['scheduler'].close()
+    if isinstance(connect['state_store'], CachedStateStore):
+        await connect['state_store'].close()
+
+
 async def listen_server():
     env = Env()
     env.read_env()
-    redis_password = env.str('REDIS_PASSWORD')
-    redis_host = env.str('REDIS_HOST')
-    redis_port = env.str('REDIS_PORT')
-    redis_db = redis.Redis(host=redis_host, port=redis_port, password=redis_password)
+    redis_db = create_redis(env)
     token = env.str('TOKEN')
     group_id = env.int('GROUP_ID')
-    async with aiohttp.ClientSession() as session:
-        key, server, ts = await get_long_poll_server(session, token, group_id)
-        connect = {'session': session, 'token': token, 'redis_db': redis_db}
-        while True:
-            try:
-                response = await connect_server(session, key, server, ts)
-                ts = response['ts']
-                events = response['updates']
-                pprint(events)
-                for event in events:
-                    if event['type'] != 'message_new':
-                        continue
-                    await event_handler(connect, event)
-            except ConnectionError as err:
-                sleep(5)
-                print(err)
-                key, server, ts = await get_long_poll_server(session, token, group_id)
-                continue
-            except requests.exceptions.ReadTimeout as err:
-                sleep(5)
-                print(err)
-                continue
-            except Exception as err:
-                sleep(5)
-                print(err)
+    dispatcher = Dispatcher(
+        handle_update,
+        workers=env.int('WORKERS', 8),
+        queue_size=env.int('QUEUE_SIZE', 100)
+    )
+    await dispatcher.start()
+    async with create_transports(env) as transports:
+        connect = await create_connect(transports, token, redis_db, group_id, **connect_options(env))
+        checkpoint = TsCheckpoint(redis_db, f'vk_longpoll:{group_id}:ts')
+        client = LongPollClient(
+            transports.api, token, group_id,
+            ts=await checkpoint.load(), wait=transports.wait, poll_session=transports.poll
+        )
+        register_collectors(connect, dispatcher, client)
+        metrics_port = env.int('METRICS_PORT', 0)
+        if metrics_port:
+            await start_metrics_server(metrics_port)
+        try:
+            await listen_updates(connect, dispatcher, checkpoint, client)
+        finally:
+            await dispatcher.close()
+            await checkpoint.flush()
+            await close_connect(connect)
+
 
 async def listen_server_v1():
     token = settings.VK_TOKEN
-    async with aiohttp.ClientSession() as session:
-        key, server, ts = await get_long_poll_server(session, token, settings.VK_GROUP_ID)
-        connect = {'session': session, 'token': token, 'redis_db': settings.REDIS_DB}
-        while True:
-            try:
-                params = {'act': 'a_check', 'key': key, 'ts': ts, 'wait': 25}
-                async with session.get(server, params=params) as res:
-                    res.raise_for_status()
-                    response = json.loads(await res.text())
-                if 'failed' in response:
-                    if response['failed'] == 1:
-                        ts = response['ts']
-                    elif response['failed'] == 2:
-                        key, __, __ = await get_long_poll_server(session, token, settings.VK_GROUP_ID)
-                    elif response['failed'] == 3:
-                        key, __, ts = await get_long_poll_server(session, token, settings.VK_GROUP_ID)
-                    continue
-                ts = response['ts']
-                for event in response['updates']:
-                    if event['type'] != 'message_new':
-                        continue
-                    await asyncio.sleep(0.2)
-                    await event_handler(connect, event)
-            except ConnectionError as err:
-                sleep(5)
-                logger.warning(f'Соединение было прервано: {err}', stack_info=True)
-                key, server, ts = await get_long_poll_server(session, token, settings.VK_GROUP_ID)
-                continue
-            except client_exceptions.ServerTimeoutError as err:
-                logger.warning(f'Ошибка ReadTimeout: {err}', stack_info=True)
-                key, server, ts = await get_long_poll_server(session, token, settings.VK_GROUP_ID)
-                continue
-            except Exception as err:
-                logger.exception(err)
-                key, server, ts = await get_long_poll_server(session, token, settings.VK_GROUP_ID)
+    dispatcher = Dispatcher(
+        handle_update,
+        workers=getattr(settings, 'VK_WORKERS', 8),
+        queue_size=getattr(settings, 'VK_QUEUE_SIZE', 100)
+    )
+    await dispatcher.start()
+    async with Transports() as transports:
+        redis_db = async_redis_from(settings.REDIS_DB)
+        connect = await create_connect(
+            transports, token, redis_db, settings.VK_GROUP_ID,
+            send_rate=getattr(settings, 'VK_SEND_RATE', 20),
+            send_queue_size=getattr(settings, 'VK_SEND_QUEUE_SIZE', 1000)
+        )
+        checkpoint = TsCheckpoint(redis_db, f'vk_longpoll:{settings.VK_GROUP_ID}:ts')
+        client = LongPollClient(
+            transports.api, token, settings.VK_GROUP_ID,
+            ts=await checkpoint.load(), wait=transports.wait, poll_session=transports.poll
+        )
+        try:
+            await listen_updates(connect, dispatcher, checkpoint, client)
+        finally:
+            await dispatcher.close()
+            await checkpoint.flush()
+            await close_connect(connect)
         logger.critical('Бот вышел из цикла и упал:', stack_info=True)
 
 
-
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(listen_server())
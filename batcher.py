@@ -0,0 +1,147 @@
+import asyncio
+import logging
+
+from functools import partial
+
+import codec
+
+from metrics import API_ERRORS
+from vk_api import VkApiError, call_method, execute_code, group_labels, is_rate_limit_error, submit
+
+
+logger = logging.getLogger(__name__)
+
+MAX_EXECUTE_CALLS = 25
+
+
+def build_execute_code(calls):
+    """VKScript, который вызывает методы по порядку и возвращает массив их результатов"""
+    api_calls = ','.join(
+        f'API.{method}({codec.dumps(params)})'
+        for method, params in calls
+    )
+    return f'return [{api_calls}];'
+
+
+class ExecuteBatcher:
+    """
+    Собирает вызовы методов API за window секунд и отправляет их
+    одним запросом execute (до 25 вызовов), затем раздает результаты
+    и ошибки ожидающим вызовам. Вызовы с разным приоритетом
+    собираются в разные пачки. Одиночный вызов уходит обычным запросом.
+
+    Ошибку лимита (6, 9, 29) внутри execute очередь отправки не видит,
+    поэтому такой вызов сам возвращается в следующую пачку с задержкой
+    retry_delay * 2 ** attempt, до max_retries раз.
+    """
+
+    def __init__(
+            self,
+            connect,
+            window: float = 0.02,
+            max_calls: int = MAX_EXECUTE_CALLS,
+            max_retries: int = 5,
+            retry_delay: float = 1,
+    ):
+        self.connect = connect
+        self.window = window
+        self.max_calls = min(max_calls, MAX_EXECUTE_CALLS)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.calls = 0
+        self.requests = 0
+        self.retried = 0
+        self._pending = {}
+        self._flush_handles = {}
+        self._tasks = set()
+
+    def stats(self):
+        return {'calls': self.calls, 'requests': self.requests, 'retried': self.retried}
+
+    async def call(self, method: str, params: dict, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        params = {param: value for param, value in params.items() if value is not None}
+        self.calls += 1
+        self._enqueue(method, params, future, priority, 0)
+        return await future
+
+    def _enqueue(self, method, params, future, priority, attempt):
+        pending = self._pending.setdefault(priority, [])
+        pending.append((method, params, future, attempt))
+        if len(pending) >= self.max_calls:
+            handle = self._flush_handles.pop(priority, None)
+            if handle:
+                handle.cancel()
+            self._start_flush(priority)
+        elif priority not in self._flush_handles:
+            self._flush_handles[priority] = asyncio.get_running_loop().call_later(
+                self.window, self._start_flush, priority
+            )
+
+    def _retry_later(self, method, params, future, priority, attempt):
+        self.retried += 1
+        scheduler = self.connect.get('scheduler')
+        if scheduler is not None:
+            scheduler.throttle(self.connect.get('group_id'))
+        logger.warning(f'Повтор {method} после ошибки лимита в execute')
+        asyncio.get_running_loop().call_later(
+            self.retry_delay * 2 ** attempt, self._enqueue, method, params, future, priority, attempt + 1
+        )
+
+    def _start_flush(self, priority):
+        self._flush_handles.pop(priority, None)
+        batch = self._pending.pop(priority, [])
+        if not batch:
+            return
+        task = asyncio.create_task(self._flush(batch, priority))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch, priority):
+        self.requests += 1
+        if len(batch) == 1:
+            method, params, future, __ = batch[0]
+            try:
+                result = await call_method(self.connect, method, params, priority=priority, batch=False)
+            except Exception as err:
+                self._set_exception(future, err)
+            else:
+                self._set_result(future, result)
+            return
+
+        code = build_execute_code((method, params) for method, params, __, __ in batch)
+        call = partial(
+            execute_code, self.connect['session'], self.connect['token'], code, group_id=self.connect.get('group_id')
+        )
+        try:
+            results, errors = await submit(self.connect, call, priority)
+        except Exception as err:
+            for __, __, future, __ in batch:
+                self._set_exception(future, err)
+            return
+
+        errors = iter(errors)
+        results = list(results or [])
+        for index, (method, params, future, attempt) in enumerate(batch):
+            if index >= len(results) or results[index] is False:
+                error = next(errors, None) or {'error_msg': f'{method} failed in execute'}
+                API_ERRORS.inc(
+                    method=method, code=error.get('error_code'), **group_labels(self.connect.get('group_id'))
+                )
+                err = VkApiError(error)
+                if is_rate_limit_error(err) and attempt < self.max_retries and not future.done():
+                    self._retry_later(method, params, future, priority, attempt)
+                else:
+                    self._set_exception(future, err)
+            else:
+                self._set_result(future, results[index])
+
+    @staticmethod
+    def _set_result(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future, err):
+        if not future.done():
+            future.set_exception(err)
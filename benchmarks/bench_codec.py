@@ -0,0 +1,100 @@
+"""
+Сравнение JSON-кодеков на пачках событий long poll.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_codec.py [--events 100] [--repeat 2000]
+"""
+import argparse
+import json
+import random
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_batch(events: int):
+    updates = []
+    for i in range(events):
+        payload = random.choice([None, {'button': 'future_courses'}, {'course_pk': i, 'button': 'past_courses'}])
+        message = {
+            'date': 1680000000 + i,
+            'from_id': 100000 + i,
+            'id': i,
+            'out': 0,
+            'attachments': [],
+            'conversation_message_id': i,
+            'fwd_messages': [],
+            'important': False,
+            'is_hidden': False,
+            'peer_id': 100000 + i,
+            'random_id': 0,
+            'text': random.choice(['Начать', 'Предстоящие курсы', 'Хочу записаться на курс по фотографии']),
+        }
+        if payload:
+            message['payload'] = json.dumps(payload)
+        updates.append({
+            'group_id': 1,
+            'type': 'message_new',
+            'event_id': f'{i:040x}',
+            'v': '5.131',
+            'object': {
+                'message': message,
+                'client_info': {
+                    'button_actions': ['text', 'vkpay', 'open_app', 'location', 'open_link', 'callback'],
+                    'keyboard': True,
+                    'inline_keyboard': True,
+                    'carousel': True,
+                    'lang_id': 0,
+                },
+            },
+        })
+    return {'ts': '1000', 'updates': updates}
+
+
+def make_codecs():
+    codecs = {
+        'json': (
+            json.loads,
+            lambda obj: json.dumps(obj, ensure_ascii=False),
+        ),
+    }
+    if orjson:
+        codecs['orjson'] = (
+            orjson.loads,
+            lambda obj: orjson.dumps(obj).decode('utf-8'),
+        )
+    return codecs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=100, help='событий в одной пачке')
+    parser.add_argument('--repeat', type=int, default=2000, help='повторов на замер')
+    args = parser.parse_args()
+
+    batch = make_batch(args.events)
+    raw = json.dumps(batch, ensure_ascii=False).encode('utf-8')
+    print(f'Пачка: {args.events} событий, {len(raw)} байт')
+    if not orjson:
+        print('orjson не установлен, замер только для stdlib json')
+
+    for name, (loads, dumps) in make_codecs().items():
+        # Ответ разбирается из bytes, затем payload каждого сообщения - как в боте
+        def decode():
+            for update in loads(raw)['updates']:
+                loads(update['object']['message'].get('payload', '{}'))
+
+        decode_time = timeit.timeit(decode, number=args.repeat) / args.repeat
+        encode_time = timeit.timeit(lambda: dumps(batch), number=args.repeat) / args.repeat
+        print(
+            f'{name:>7}: разбор {decode_time * 1e6:8.1f} мкс/пачка '
+            f'({args.events / decode_time:10.0f} событий/с), '
+            f'сериализация {encode_time * 1e6:8.1f} мкс/пачка'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Сквозной замер пропускной способности и задержки ответа бота.
+
+Поднимает локальную замену VK API (fake_vk.py), запускает async_longpoll.py
+или longpoll.py против нее, подает синтетические сообщения message_new
+и считает время от появления события до последнего ответа на него.
+
+Нужен запущенный Redis (REDIS_HOST, REDIS_PORT, REDIS_PASSWORD).
+Запуск из корня репозитория:
+    python benchmarks/bench_e2e.py --bot async --events 2000 --rate 200
+    python benchmarks/bench_e2e.py --bot sync --latency 0.05 --rate-limit 20 --failed 1,2,3
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_vk import FakeVk  # noqa: E402
+
+
+def start_in_thread(coroutine_factory):
+    """Запускает корутину в отдельном потоке со своим циклом событий, возвращает цикл"""
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_until_complete(coroutine_factory())
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return loop
+
+
+def start_fake(fake: FakeVk):
+    started = threading.Event()
+
+    async def serve():
+        await fake.start()
+        started.set()
+        await asyncio.Event().wait()
+
+    loop = start_in_thread(serve)
+    started.wait()
+    return loop
+
+
+def start_bot(bot: str, workers: int):
+    if bot == 'async':
+        import async_longpoll
+        start_in_thread(async_longpoll.listen_server)
+        return
+
+    import redis
+    import longpoll
+    from storage import SyncStateStore
+
+    redis_db = redis.Redis(
+        host=os.environ['REDIS_HOST'],
+        port=os.environ['REDIS_PORT'],
+        password=os.environ['REDIS_PASSWORD'],
+    )
+    longpoll.configure_sessions(workers)
+    threading.Thread(
+        target=longpoll.listen_server,
+        args=(os.environ['TOKEN'], int(os.environ['GROUP_ID']), SyncStateStore(redis_db)),
+        kwargs={'workers': workers},
+        daemon=True,
+    ).start()
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bot', choices=('async', 'sync'), default='async')
+    parser.add_argument('--events', type=int, default=1000, help='сколько сообщений подать')
+    parser.add_argument('--users', type=int, default=100, help='число разных отправителей')
+    parser.add_argument('--rate', type=float, default=100, help='сообщений в секунду')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа API, с')
+    parser.add_argument('--rate-limit', type=float, default=None, help='запросов в секунду до ошибки 6')
+    parser.add_argument('--failed', default='', help='ответы failed long poll по порядку, например 1,2,3')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=60, help='сколько ждать ответов после подачи')
+    args = parser.parse_args()
+
+    group_id = random.randint(10 ** 8, 10 ** 9)
+    fake = FakeVk(
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        failed_script=[int(code) for code in args.failed.split(',') if code],
+        replies_per_event=2,
+        group_id=group_id,
+    )
+    fake_loop = start_fake(fake)
+
+    os.environ['VK_API_URL'] = f'{fake.base_url}/method/'
+    os.environ['TOKEN'] = 'benchmark'
+    os.environ['GROUP_ID'] = str(group_id)
+    os.environ['WORKERS'] = str(args.workers)
+    os.environ.setdefault('REDIS_HOST', 'localhost')
+    os.environ.setdefault('REDIS_PORT', '6379')
+    os.environ.setdefault('REDIS_PASSWORD', '')
+    if args.rate_limit:
+        os.environ.setdefault('SEND_RATE', str(args.rate_limit))
+    start_bot(args.bot, args.workers)
+    time.sleep(1)
+
+    # На сообщение "start" бот отвечает двумя сообщениями: приветствием и меню
+    started_at = time.monotonic()
+    for i in range(args.events):
+        user_id = 1000 + i % args.users
+        asyncio.run_coroutine_threadsafe(fake.inject(user_id, 'start'), fake_loop).result()
+        delay = started_at + (i + 1) / args.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    injected_at = time.monotonic()
+
+    deadline = injected_at + args.timeout
+    while fake.completed < args.events and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started_at
+
+    latencies = list(fake.latencies)
+    print(f'Бот: {args.bot}, событий: {args.events}, пользователей: {args.users}, подача: {args.rate}/с')
+    print(f'Обработано: {len(latencies)} за {elapsed:.2f} с, {len(latencies) / elapsed:.1f} событий/с')
+    if latencies:
+        print(
+            f'Задержка событие-ответ: p50 {percentile(latencies, 0.5) * 1000:.1f} мс, '
+            f'p99 {percentile(latencies, 0.99) * 1000:.1f} мс, '
+            f'max {max(latencies) * 1000:.1f} мс'
+        )
+    print(f'Запросы к API: {dict(fake.requests)}, отказов по лимиту: {fake.rate_limited}')
+
+
+if __name__ == '__main__':
+    main()
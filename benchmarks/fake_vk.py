@@ -0,0 +1,197 @@
+"""
+Локальная замена VK API для нагрузочных тестов.
+
+Реализует groups.getLongPollServer, a_check long poll (с заданной
+последовательностью ответов failed), messages.send, messages.edit,
+messages.sendMessageEventAnswer, users.get и execute
+с настраиваемой задержкой и ошибкой 6 при превышении лимита запросов.
+"""
+import asyncio
+import itertools
+import json
+import uuid
+
+from collections import defaultdict, deque
+from time import monotonic
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+
+class FakeVk:
+    def __init__(
+            self,
+            latency: float = 0.0,
+            rate_limit: float = None,
+            failed_script=(),
+            replies_per_event: int = 1,
+            group_id: int = 1,
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.failed_script = deque(failed_script)
+        self.replies_per_event = replies_per_event
+        self.group_id = group_id
+        self.events = []
+        self.key = uuid.uuid4().hex
+        self.base_url = None
+        self.requests = defaultdict(int)
+        self.rate_limited = 0
+        self.latencies = []
+        self._message_ids = itertools.count(1)
+        self._pending = defaultdict(deque)
+        self._replies = defaultdict(int)
+        self._new_events = None
+        self._window = deque()
+        self._runner = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route('*', '/method/{method}', self.handle_method)
+        app.router.add_get('/poll', self.handle_poll)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self._new_events = asyncio.Condition()
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f'http://{host}:{port}'
+        return self.base_url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    @property
+    def completed(self):
+        return len(self.latencies)
+
+    async def inject(self, user_id: int, text: str, payload: dict = None):
+        """Добавляет событие message_new от user_id"""
+        message = {
+            'date': 0,
+            'from_id': user_id,
+            'peer_id': user_id,
+            'id': len(self.events) + 1,
+            'conversation_message_id': len(self.events) + 1,
+            'text': text,
+            'out': 0,
+        }
+        if payload:
+            message['payload'] = json.dumps(payload)
+        self.events.append({
+            'type': 'message_new',
+            'event_id': uuid.uuid4().hex,
+            'group_id': self.group_id,
+            'v': '5.131',
+            'object': {'message': message, 'client_info': {}},
+        })
+        self._pending[user_id].append(monotonic())
+        async with self._new_events:
+            self._new_events.notify_all()
+
+    def _record_reply(self, user_id):
+        self._replies[user_id] += 1
+        if self._replies[user_id] % self.replies_per_event == 0 and self._pending[user_id]:
+            self.latencies.append(monotonic() - self._pending[user_id].popleft())
+
+    def _over_rate_limit(self):
+        if not self.rate_limit:
+            return False
+        now = monotonic()
+        while self._window and now - self._window[0] > 1:
+            self._window.popleft()
+        if len(self._window) >= self.rate_limit:
+            self.rate_limited += 1
+            return True
+        self._window.append(now)
+        return False
+
+    async def handle_poll(self, request):
+        self.requests['a_check'] += 1
+        if request.query.get('key') != self.key:
+            return web.json_response({'failed': 2})
+        if self.failed_script:
+            failed = self.failed_script.popleft()
+            if failed == 1:
+                return web.json_response({'failed': 1, 'ts': str(len(self.events))})
+            return web.json_response({'failed': failed})
+        ts = int(request.query['ts'])
+        if ts > len(self.events):
+            return web.json_response({'failed': 1, 'ts': str(len(self.events))})
+        wait = int(request.query.get('wait', 25))
+        if ts == len(self.events):
+            async with self._new_events:
+                try:
+                    await asyncio.wait_for(
+                        self._new_events.wait_for(lambda: ts < len(self.events)), wait
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        updates = self.events[ts:]
+        return web.json_response({'ts': str(ts + len(updates)), 'updates': updates})
+
+    async def handle_method(self, request):
+        method = request.match_info['method']
+        params = dict(request.query)
+        if request.method == 'POST':
+            params.update(parse_qsl(await request.text()))
+        self.requests[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method != 'groups.getLongPollServer' and self._over_rate_limit():
+            return web.json_response(
+                {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}}
+            )
+        if method == 'execute':
+            results, errors = [], []
+            for sub_method, sub_params in parse_execute(params['code']):
+                self.requests[sub_method] += 1
+                response = self.call(sub_method, sub_params)
+                if 'error' in response:
+                    results.append(False)
+                    errors.append(dict(response['error'], method=sub_method))
+                else:
+                    results.append(response['response'])
+            return web.json_response({'response': results, 'execute_errors': errors})
+        return web.json_response(self.call(method, params))
+
+    def call(self, method, params):
+        if method == 'groups.getLongPollServer':
+            response = {'key': self.key, 'server': f'{self.base_url}/poll', 'ts': str(len(self.events))}
+        elif method == 'messages.send' and params.get('peer_ids'):
+            self.requests['messages.send.peers'] += len(str(params['peer_ids']).split(','))
+            response = [
+                {'peer_id': int(peer_id), 'message_id': next(self._message_ids)}
+                for peer_id in str(params['peer_ids']).split(',')
+            ]
+        elif method == 'messages.send':
+            self._record_reply(int(params['user_id']))
+            response = next(self._message_ids)
+        elif method in ('messages.edit', 'messages.sendMessageEventAnswer'):
+            response = 1
+        elif method == 'users.get':
+            user_ids = str(params['user_ids']).split(',')
+            response = [
+                {'id': int(user_id), 'first_name': 'User', 'last_name': user_id}
+                for user_id in user_ids
+            ]
+        else:
+            return {'error': {'error_code': 3, 'error_msg': f'Unknown method {method}'}}
+        return {'response': response}
+
+
+def parse_execute(code: str):
+    """Разбирает код вида return [API.method({...}),...]; в список (method, params)"""
+    decoder = json.JSONDecoder()
+    calls = []
+    position = code.index('[') + 1
+    while True:
+        position = code.find('API.', position)
+        if position == -1:
+            return calls
+        bracket = code.index('(', position)
+        method = code[position + len('API.'):bracket]
+        params, position = decoder.raw_decode(code, bracket + 1)
+        calls.append((method, params))
@@ -0,0 +1,229 @@
+"""
+Рассылка одного сообщения многим пользователям.
+
+    python broadcast.py new-course --text "Открыта запись на новый курс"
+    python broadcast.py new-course --text "..." --users 1,2,3
+    python broadcast.py new-course --status
+    python broadcast.py new-course --text "..." --state-prefix 123:
+
+Сообщение отправляется через messages.send с peer_ids пачками по 100
+получателей с низким приоритетом, поэтому ответы пользователям идут
+вперед рассылки. Получатели и номер следующей пачки хранятся в Redis:
+прерванная рассылка с тем же id продолжается с места остановки.
+"""
+import argparse
+import asyncio
+import logging
+import zlib
+import redis.asyncio
+
+from environs import Env
+
+from async_longpoll import close_connect, connect_options, create_connect, create_redis, create_transports
+from metrics import REDIS_SECONDS
+from outbox import is_transient_error
+from scheduler import PRIORITY_BULK
+from vk_api import call_method
+
+
+logger = logging.getLogger(__name__)
+
+PEERS_PER_REQUEST = 100
+
+
+def broadcast_key(broadcast_id: str):
+    return f'broadcast:{broadcast_id}'
+
+
+async def known_users(redis_db: redis.asyncio.Redis, state_prefix: str = ''):
+    """
+    id всех пользователей, для которых в Redis сохранено состояние
+    с префиксом state_prefix (в multigroup.py по умолчанию '{group_id}:')
+    """
+    user_ids = set()
+    async for key in redis_db.scan_iter(match=f'{state_prefix}[0-9]*', count=1000):
+        key = key.decode('utf-8') if isinstance(key, bytes) else key
+        user_id = key[len(state_prefix):]
+        if user_id.isdigit():
+            user_ids.add(int(user_id))
+    return sorted(user_ids)
+
+
+class Broadcast:
+    """
+    Рассылка с сохранением прогресса.
+
+    В Redis лежат текст broadcast:{id}:message и список получателей
+    broadcast:{id}:audience, записанные один раз при создании, и хэш
+    broadcast:{id} с полями total, offset (сколько получателей уже
+    обработано), delivered и failed. random_id пачки вычисляется из id
+    рассылки и смещения, поэтому пачка, отправленная повторно после
+    перезапуска, не дублируется VK.
+
+    failed считает только получателей, которым VK отказал окончательно.
+    При временной ошибке (лимит, сбой сети или VK) offset сдвигается
+    только за пачки до нее, а рассылка продолжается с этого места через
+    retry_delay * 2 ** attempt секунд; после max_retries неудачных
+    попыток подряд ошибка поднимается и рассылку можно продолжить позже.
+    """
+
+    def __init__(
+            self,
+            connect,
+            broadcast_id: str,
+            message: str = None,
+            keyboard: str = None,
+            attachment: str = None,
+            state_prefix: str = '',
+            parallel: int = 5,
+            max_retries: int = 8,
+            retry_delay: float = 1,
+            max_delay: float = 300,
+    ):
+        self.connect = connect
+        self.db = connect['redis_db']
+        self.broadcast_id = broadcast_id
+        self.key = broadcast_key(broadcast_id)
+        self.audience_key = f'{self.key}:audience'
+        self.message_key = f'{self.key}:message'
+        self.message = message
+        self.keyboard = keyboard
+        self.attachment = attachment
+        self.state_prefix = state_prefix
+        self.parallel = parallel
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+
+    async def exists(self):
+        return bool(await self.db.exists(self.key))
+
+    async def create(self, user_ids=None):
+        """Сохраняет текст и получателей, если рассылки с таким id еще нет; без user_ids - все известные"""
+        if await self.exists():
+            return False
+        if user_ids is None:
+            user_ids = await known_users(self.db, self.state_prefix)
+        async with self.db.pipeline(transaction=True) as pipe:
+            pipe.set(self.message_key, self.message)
+            if user_ids:
+                pipe.rpush(self.audience_key, *user_ids)
+            pipe.hset(self.key, mapping={'total': len(user_ids), 'offset': 0, 'delivered': 0, 'failed': 0})
+            await pipe.execute()
+        return True
+
+    async def status(self):
+        values = await self.db.hgetall(self.key)
+        return {name.decode('utf-8'): int(value) for name, value in values.items()}
+
+    async def run(self):
+        """Отправляет оставшиеся пачки и возвращает итоговый status()"""
+        status = await self.status()
+        self.message = (await self.db.get(self.message_key)).decode('utf-8')
+        offset = status['offset']
+        step = PEERS_PER_REQUEST * self.parallel
+        attempt = 0
+        while offset < status['total']:
+            with REDIS_SECONDS.time(op='broadcast_audience'):
+                user_ids = await self.db.lrange(self.audience_key, offset, offset + step - 1)
+            if not user_ids:
+                break
+            batches = [
+                (offset + start, [int(user_id) for user_id in user_ids[start:start + PEERS_PER_REQUEST]])
+                for start in range(0, len(user_ids), PEERS_PER_REQUEST)
+            ]
+            results = await asyncio.gather(*(self._send(*batch) for batch in batches), return_exceptions=True)
+            # пачки после первой временной ошибки отправятся снова с тем же random_id
+            done = 0
+            while done < len(results) and not isinstance(results[done], Exception):
+                done += 1
+            if done:
+                offset += sum(len(batch[1]) for batch in batches[:done])
+                async with self.db.pipeline(transaction=True) as pipe:
+                    pipe.hset(self.key, 'offset', offset)
+                    pipe.hincrby(self.key, 'delivered', sum(result[0] for result in results[:done]))
+                    pipe.hincrby(self.key, 'failed', sum(result[1] for result in results[:done]))
+                    await pipe.execute()
+                logger.info(f'Рассылка {self.broadcast_id}: {offset}/{status["total"]}')
+            if done == len(results):
+                attempt = 0
+                continue
+            error = results[done]
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+            delay = min(self.max_delay, self.retry_delay * 2 ** (attempt - 1))
+            logger.warning(f'Рассылка {self.broadcast_id}, пачка {offset}: {error}, повтор через {delay:.0f} с')
+            await asyncio.sleep(delay)
+        return await self.status()
+
+    def _random_id(self, offset):
+        return zlib.crc32(f'{self.broadcast_id}:{offset}'.encode('utf-8')) & 0x7fffffff
+
+    async def _send(self, offset, user_ids):
+        """Возвращает (доставлено, не доставлено) для одной пачки; временные ошибки поднимаются"""
+        params = {
+            'peer_ids': ','.join(str(user_id) for user_id in user_ids),
+            'random_id': self._random_id(offset),
+            'message': self.message,
+            'keyboard': self.keyboard,
+            'attachment': self.attachment,
+        }
+        try:
+            response = await call_method(self.connect, 'messages.send', params, priority=PRIORITY_BULK)
+        except Exception as err:
+            if is_transient_error(err):
+                raise
+            logger.warning(f'Рассылка {self.broadcast_id}, пачка {offset}: {err}')
+            return 0, len(user_ids)
+        delivered = sum(1 for item in response if 'message_id' in item)
+        return delivered, len(user_ids) - delivered
+
+
+async def broadcast(
+        broadcast_id: str,
+        text: str = None,
+        user_ids=None,
+        show_status: bool = False,
+        state_prefix: str = '',
+):
+    env = Env()
+    env.read_env()
+    redis_db = create_redis(env)
+    async with create_transports(env) as transports:
+        connect = await create_connect(
+            transports, env.str('TOKEN'), redis_db, env.int('GROUP_ID'), **connect_options(env),
+            state_prefix=state_prefix
+        )
+        job = Broadcast(connect, broadcast_id, text, state_prefix=state_prefix)
+        try:
+            if not await job.exists():
+                if show_status or text is None:
+                    raise SystemExit(f'Рассылка {broadcast_id} не найдена, для новой рассылки укажите --text')
+                await job.create(user_ids)
+            if not show_status:
+                await job.run()
+            return await job.status()
+        finally:
+            await close_connect(connect)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('broadcast_id', help='id рассылки, с тем же id прерванная рассылка продолжается')
+    parser.add_argument('--text', help='текст сообщения новой рассылки')
+    parser.add_argument('--users', help='id получателей через запятую, по умолчанию все известные')
+    parser.add_argument('--status', action='store_true', help='только показать прогресс')
+    parser.add_argument(
+        '--state-prefix', default='',
+        help='префикс ключей состояний, для сообщества из multigroup.py - "{group_id}:"'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    user_ids = [int(user_id) for user_id in args.users.split(',')] if args.users else None
+    status = asyncio.run(broadcast(args.broadcast_id, args.text, user_ids, args.status, args.state_prefix))
+    print(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,61 @@
-import json
+from collections import OrderedDict
 
+import codec
 
-async def get_start_buttons():
-    start_buttons = [
-        ('Предстоящие курсы', 'future_courses'),
-        ('Ваши курсы', 'client_courses'),
-        ('Прошедшие курсы', 'past_courses'),
-        ('Написать администратору', 'admin_msg'),
-        ('Как нас найти', 'search_us')
-    ]
+
+START_BUTTONS = [
+    ('Предстоящие курсы', 'future_courses'),
+    ('Ваши курсы', 'client_courses'),
+    ('Прошедшие курсы', 'past_courses'),
+    ('Написать администратору', 'admin_msg'),
+    ('Как нас найти', 'search_us')
+]
+# Разделы, которые листаются callback-кнопками с правкой сообщения
+PAGED_BUTTONS = ('future_courses', 'client_courses', 'past_courses')
+COLORS = ('primary', 'secondary', 'negative', 'positive')
+COURSE_KEYBOARDS_CACHE_SIZE = 256
+
+
+def _action_type(callback):
+    return 'callback' if callback else 'text'
+
+
+def build_start_keyboard(callback=False):
     buttons = []
-    for label, payload in start_buttons:
+    for label, payload in START_BUTTONS:
+        action_type = _action_type(callback and payload in PAGED_BUTTONS)
         buttons.append(
             [
                 {
-                    'action': {'type': 'text', 'payload': {'button': payload}, 'label': label},
+                    'action': {'type': action_type, 'payload': {'button': payload}, 'label': label},
                     'color': 'secondary'
                 }
             ],
         )
     keyboard = {'inline': True, 'buttons': buttons}
-    return json.dumps(keyboard, ensure_ascii=False)
+    return codec.dumps(keyboard)
 
 
-async def get_menu_button(color, inline):
+def build_menu_keyboard(color, inline, callback=False):
     button = [
         [
             {
-                'action': {'type': 'text', 'payload': {'button': 'start'}, 'label': '☰ MENU'},
+                'action': {'type': _action_type(callback), 'payload': {'button': 'start'}, 'label': '☰ MENU'},
                 'color': color
             }
         ]
     ]
     keyboard = {'inline': inline, 'buttons': button}
-    return json.dumps(keyboard, ensure_ascii=False)
+    return codec.dumps(keyboard)
 
 
-async def get_course_buttons(course_instances, back):
+def build_course_keyboard(course_instances, back, page=None, pages=None):
+    """
+    Клавиатура страницы курсов. С page и pages - для листания в том же
+    сообщении: кнопки назад, вперед и меню становятся callback-кнопками.
+    """
     buttons = []
+    callback = page is not None
     gallery_payload = None
     for course in course_instances:
         if course.name == 'Фотогалерея':
@@ -55,18 +73,28 @@ async def get_course_buttons(course_instances, back):
                 }
             ],
         )
-    buttons.append(
-        [
-            {
-                'action': {
-                    'type': 'text',
-                    'payload': {'button': 'start'},
-                    'label': '☰ MENU'
-                },
-                'color': 'primary'
-            }
-        ],
-    )
+    menu_row = [
+        {
+            'action': {
+                'type': _action_type(callback),
+                'payload': {'button': 'start'},
+                'label': '☰ MENU'
+            },
+            'color': 'primary'
+        }
+    ]
+    # inline-клавиатура ограничена 6 рядами, поэтому листание - в ряду меню
+    if callback and page > 0:
+        menu_row.insert(0, {
+            'action': {'type': 'callback', 'payload': {'button': back, 'page': page - 1}, 'label': '◀'},
+            'color': 'secondary'
+        })
+    if callback and page < pages - 1:
+        menu_row.append({
+            'action': {'type': 'callback', 'payload': {'button': back, 'page': page + 1}, 'label': '▶'},
+            'color': 'secondary'
+        })
+    buttons.append(menu_row)
     if gallery_payload:
         buttons[-1].append(
             {
@@ -79,4 +107,48 @@ async def get_course_buttons(course_instances, back):
             }
         )
     keyboard = {'inline': True, 'buttons': buttons}
-    return json.dumps(keyboard, ensure_ascii=False)
+    return codec.dumps(keyboard)
+
+
+# Статичные клавиатуры сериализуются один раз при импорте
+START_KEYBOARD = build_start_keyboard()
+START_CALLBACK_KEYBOARD = build_start_keyboard(callback=True)
+MENU_KEYBOARDS = {
+    (color, inline): build_menu_keyboard(color, inline)
+    for color in COLORS
+    for inline in (True, False)
+}
+MENU_CALLBACK_KEYBOARDS = {color: build_menu_keyboard(color, True, callback=True) for color in COLORS}
+
+_course_keyboards = OrderedDict()
+_courses_version = 0
+
+
+def invalidate_course_buttons():
+    """Сбрасывает кэш клавиатур курсов, вызывать при изменении курсов"""
+    global _courses_version
+    _courses_version += 1
+    _course_keyboards.clear()
+
+
+async def get_start_buttons(callback=False):
+    return START_CALLBACK_KEYBOARD if callback else START_KEYBOARD
+
+
+async def get_menu_button(color, inline, callback=False):
+    if callback:
+        return MENU_CALLBACK_KEYBOARDS[color]
+    return MENU_KEYBOARDS[(color, inline)]
+
+
+async def get_course_buttons(course_instances, back, page=None, pages=None):
+    key = (tuple(course.pk for course in course_instances), back, page, pages, _courses_version)
+    keyboard = _course_keyboards.get(key)
+    if keyboard is None:
+        keyboard = build_course_keyboard(course_instances, back, page, pages)
+        _course_keyboards[key] = keyboard
+        while len(_course_keyboards) > COURSE_KEYBOARDS_CACHE_SIZE:
+            _course_keyboards.popitem(last=False)
+    else:
+        _course_keyboards.move_to_end(key)
+    return keyboard
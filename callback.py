@@ -0,0 +1,158 @@
+"""
+Прием событий через Callback API вместо long poll.
+
+    python callback.py
+
+VK присылает события POST-запросом на CALLBACK_PATH. Сервер проверяет
+секретный ключ, сразу отвечает "ok" и передает message_new и message_event
+в тот же Dispatcher и handle_update, что и long poll. VK повторяет событие, если
+не получил "ok", поэтому повторы отсекаются по event_id.
+"""
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from environs import Env
+
+import codec
+
+from async_longpoll import (
+    close_connect, connect_options, create_connect, create_redis, create_transports, handle_update,
+)
+from dispatcher import Dispatcher
+from events import EVENT_TYPES, parse_event
+from metrics import REGISTRY, log_sampled, start_metrics_server, stats_collector
+
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackHandler:
+    """
+    Обработчик запросов Callback API одного сообщества.
+
+    confirmation - строка, которую сервер должен вернуть на событие
+    confirmation, secret - секретный ключ из настроек Callback API
+    (пустой - не проверяется).
+
+    "ok" возвращается сразу, а проверка повтора и постановка в очередь
+    идут в фоновой задаче, поэтому заполненная очередь воркеров не
+    задерживает ответ и VK не присылает событие заново.
+    """
+
+    def __init__(self, connect, dispatcher: Dispatcher, group_id: int, confirmation: str, secret: str = ''):
+        self.connect = connect
+        self.dispatcher = dispatcher
+        self.group_id = group_id
+        self.confirmation = confirmation
+        self.secret = secret
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self._in_flight = set()
+        self._tasks = set()
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'in_flight': len(self._in_flight),
+            'accepting': len(self._tasks),
+        }
+
+    async def close(self):
+        """Дожидается постановки в очередь уже принятых событий"""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def handle(self, request: web.Request):
+        try:
+            event = codec.loads(await request.read())
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+        if event.get('group_id') != self.group_id:
+            self.rejected += 1
+            return web.Response(status=403)
+        if event.get('type') == 'confirmation':
+            return web.Response(text=self.confirmation)
+        if self.secret and not hmac.compare_digest(str(event.get('secret', '')), self.secret):
+            self.rejected += 1
+            return web.Response(status=403)
+        self.received += 1
+        if event.get('type') in EVENT_TYPES:
+            self.accept(event)
+        return web.Response(text='ok')
+
+    def accept(self, event):
+        """Запускает постановку события в очередь в фоне, если оно не обрабатывается сейчас"""
+        event_id = event.get('event_id')
+        if event_id in self._in_flight:
+            self.duplicates += 1
+            return
+        self._in_flight.add(event_id)
+        task = asyncio.create_task(self._enqueue(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _enqueue(self, event):
+        """Ставит событие в очередь, если оно еще не обработано"""
+        event_id = event.get('event_id')
+        done = None
+        try:
+            if not await self.connect['seen_events'].filter_new([event]):
+                self.duplicates += 1
+                return
+            message = parse_event(event)
+            log_sampled(logger, 'callback', user_id=message.user_id, event_id=event_id)
+            done = await self.dispatcher.dispatch(message.user_id, self.connect, message)
+        except Exception as err:
+            logger.exception(f'Событие {event_id} не принято: {err}')
+        finally:
+            if done is None:
+                self._in_flight.discard(event_id)
+            else:
+                done.add_done_callback(lambda __: self._in_flight.discard(event_id))
+
+
+async def callback_server():
+    env = Env()
+    env.read_env()
+    redis_db = create_redis(env)
+    token = env.str('TOKEN')
+    group_id = env.int('GROUP_ID')
+    dispatcher = Dispatcher(
+        handle_update,
+        workers=env.int('WORKERS', 8),
+        queue_size=env.int('QUEUE_SIZE', 100)
+    )
+    await dispatcher.start()
+    async with create_transports(env) as transports:
+        connect = await create_connect(transports, token, redis_db, group_id, **connect_options(env))
+        handler = CallbackHandler(
+            connect, dispatcher, group_id,
+            confirmation=env.str('CALLBACK_CONFIRMATION'),
+            secret=env.str('CALLBACK_SECRET', '')
+        )
+        REGISTRY.add_collector(stats_collector('vk_callback', handler.stats))
+        app = web.Application()
+        app.router.add_post(env.str('CALLBACK_PATH', '/callback'), handler.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, env.str('CALLBACK_HOST', '0.0.0.0'), env.int('CALLBACK_PORT', 8080)).start()
+        metrics_port = env.int('METRICS_PORT', 0)
+        if metrics_port:
+            await start_metrics_server(metrics_port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await handler.close()
+            await dispatcher.close()
+            await close_connect(connect)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(callback_server())
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import redis.asyncio
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from time import monotonic
+
+from more_itertools import chunked
+
+import codec
+
+from buttons import get_course_buttons, invalidate_course_buttons
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'courses:version'
+PUBLIC_SECTIONS = ('future_courses', 'past_courses')
+USER_SECTIONS = ('client_courses',)
+PAGE_SIZE = 5
+
+
+async def bump_courses_version(redis_db: redis.asyncio.Redis):
+    """Вызывать после изменения курсов или записей на них: все процессы перестроят страницы"""
+    invalidate_course_buttons()
+    return await redis_db.incr(VERSION_KEY)
+
+
+def parse_boundary(boundary):
+    if not boundary:
+        return None
+    boundary = datetime.fromisoformat(boundary)
+    if boundary.tzinfo is None:
+        boundary = boundary.replace(tzinfo=timezone.utc)
+    return boundary
+
+
+class CourseCatalog:
+    """
+    Готовые страницы курсов для главного меню: уже разбитые по PAGE_SIZE
+    и с сериализованными клавиатурами.
+
+    Страницы общих разделов (предстоящие и прошедшие курсы) хранятся в памяти
+    и в Redis под текущей версией, страницы курсов пользователя - только
+    в памяти. Версия из Redis проверяется не чаще раза в check_interval
+    секунд; страницы перестраиваются при смене версии и когда scheduled_at
+    ближайшего предстоящего курса уже наступил. Вместе со страницами в Redis
+    записывается этот момент, и запись, срок которой прошел, не используется.
+
+    load_courses(section, user_id) - корутина, возвращающая опубликованные
+    курсы раздела из базы. Страницы с callback=True листаются callback-кнопками
+    и кэшируются отдельно от обычных.
+    """
+
+    def __init__(
+            self,
+            load_courses,
+            redis_db: redis.asyncio.Redis,
+            check_interval: float = 5,
+            users_cache_size: int = 1000,
+    ):
+        self.load_courses = load_courses
+        self.db = redis_db
+        self.check_interval = check_interval
+        self.users_cache_size = users_cache_size
+        self.version = None
+        self.boundary = None
+        self.loads = 0
+        self._checked_at = 0
+        self._pages = {}
+        self._user_pages = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    def stats(self):
+        return {'loads': self.loads, 'cached_users': len(self._user_pages)}
+
+    async def get_pages(self, section: str, user_id: int = None, callback: bool = False):
+        """Список клавиатур страниц раздела, пустой - если курсов нет"""
+        await self._check_version()
+        if self.boundary and datetime.now(timezone.utc) >= self.boundary:
+            self._reset()
+        if section in USER_SECTIONS:
+            key = (section, user_id, callback)
+            pages = self._user_pages.get(key)
+            if pages is None:
+                pages = await self._build_pages(section, user_id, callback)
+                self._user_pages[key] = pages
+                while len(self._user_pages) > self.users_cache_size:
+                    self._user_pages.popitem(last=False)
+            else:
+                self._user_pages.move_to_end(key)
+            return pages
+        if section != 'future_courses':
+            # граница прошедших курсов известна только после загрузки предстоящих
+            await self.get_pages('future_courses', callback=callback)
+        pages = self._pages.get((section, callback))
+        if pages is None:
+            async with self._lock:
+                pages = self._pages.get((section, callback))
+                if pages is None:
+                    pages = await self._load_public(section, callback)
+                    self._pages[(section, callback)] = pages
+        return pages
+
+    def _reset(self):
+        self._pages = {}
+        self._user_pages.clear()
+        self.boundary = None
+        invalidate_course_buttons()
+
+    async def _check_version(self):
+        if monotonic() - self._checked_at < self.check_interval:
+            return
+        self._checked_at = monotonic()
+        version = await self.db.get(VERSION_KEY)
+        version = int(version) if version else 0
+        if version != self.version:
+            if self.version is not None:
+                self._reset()
+            self.version = version
+
+    async def _load_public(self, section, callback):
+        key = f'courses:{self.version}:{section}{":callback" if callback else ""}'
+        cached = await self.db.get(key)
+        if cached:
+            cached = codec.loads(cached)
+            boundary = parse_boundary(cached['boundary'])
+            if boundary is None or boundary > datetime.now(timezone.utc):
+                self._update_boundary(boundary)
+                return cached['pages']
+        pages = await self._build_pages(section, callback=callback)
+        boundary = self.boundary.isoformat() if self.boundary else None
+        await self.db.set(key, codec.dumps({'pages': pages, 'boundary': boundary}), ex=24 * 60 * 60)
+        return pages
+
+    def _update_boundary(self, boundary):
+        """Запоминает ближайшую границу; уже наступившая не запоминается"""
+        if boundary and boundary > datetime.now(timezone.utc):
+            if self.boundary is None or boundary < self.boundary:
+                self.boundary = boundary
+
+    async def _build_pages(self, section, user_id=None, callback=False):
+        self.loads += 1
+        courses = list(await self.load_courses(section, user_id))
+        if section == 'future_courses':
+            scheduled = [course.scheduled_at for course in courses if course.scheduled_at]
+            if scheduled:
+                self._update_boundary(parse_boundary(min(scheduled).isoformat()))
+        pages = list(chunked(courses, PAGE_SIZE))
+        if not callback:
+            return [await get_course_buttons(page, back=section) for page in pages]
+        return [
+            await get_course_buttons(page, back=section, page=number, pages=len(pages))
+            for number, page in enumerate(pages)
+        ]
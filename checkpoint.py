@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import redis.asyncio
+
+from collections import deque
+
+from metrics import REDIS_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+
+class TsCheckpoint:
+    """
+    Сохраняет в Redis последний ts, все события до которого уже обработаны.
+
+    track вызывается на каждую пачку событий с ts, который вернул сервер,
+    и futures обработки ее событий. ts пачки записывается, только когда
+    обработаны она и все пачки до нее, поэтому после перезапуска
+    с сохраненного ts ни одно необработанное событие не теряется.
+    """
+
+    def __init__(self, redis_db: redis.asyncio.Redis, key: str):
+        self.db = redis_db
+        self.key = key
+        self.saved_ts = None
+        self._pending_ts = None
+        self._batches = deque()
+        self._saving = None
+
+    async def load(self):
+        ts = await self.db.get(self.key)
+        if ts is not None:
+            ts = ts.decode('utf-8')
+        self.saved_ts = ts
+        return ts
+
+    def track(self, ts, futures):
+        waiter = asyncio.ensure_future(asyncio.gather(*futures, return_exceptions=True))
+        self._batches.append((ts, waiter))
+        waiter.add_done_callback(self._advance)
+
+    def _advance(self, __=None):
+        ts = None
+        while self._batches and self._batches[0][1].done():
+            ts, __ = self._batches.popleft()
+        if ts is None:
+            return
+        self._pending_ts = ts
+        if self._saving is None:
+            self._saving = asyncio.create_task(self._save())
+
+    async def _save(self):
+        try:
+            while self._pending_ts != self.saved_ts:
+                ts = self._pending_ts
+                with REDIS_SECONDS.time(op='checkpoint'):
+                    await self.db.set(self.key, ts)
+                self.saved_ts = ts
+        except Exception as err:
+            logger.exception(err)
+        finally:
+            self._saving = None
+
+    async def flush(self):
+        """Дожидается обработки отслеживаемых пачек и записи последнего ts"""
+        if self._batches:
+            await asyncio.gather(*(waiter for __, waiter in self._batches))
+            self._advance()
+        if self._saving is not None:
+            await self._saving
+
+
+class SeenEvents:
+    """
+    Множество уже обработанных event_id в Redis с истечением через ttl секунд.
+
+    Событие помечается после обработки, поэтому при повторной доставке
+    после возобновления с сохраненного ts ответ не отправляется дважды,
+    а событие, обработка которого не завершилась, обрабатывается снова.
+    """
+
+    def __init__(self, redis_db: redis.asyncio.Redis, prefix: str, ttl: int = 24 * 60 * 60):
+        self.db = redis_db
+        self.prefix = prefix
+        self.ttl = ttl
+        self.duplicates = 0
+
+    async def filter_new(self, events):
+        """Отбрасывает события, чей event_id уже отмечен, одним MGET"""
+        ids = [event.get('event_id') for event in events]
+        keys = [f'{self.prefix}{event_id}' for event_id in ids if event_id]
+        if not keys:
+            return events
+        with REDIS_SECONDS.time(op='seen_filter'):
+            seen = dict(zip(keys, await self.db.mget(keys)))
+        new_events = []
+        for event_id, event in zip(ids, events):
+            if event_id and seen.get(f'{self.prefix}{event_id}'):
+                self.duplicates += 1
+                continue
+            new_events.append(event)
+        return new_events
+
+    async def mark(self, event):
+        event_id = event.get('event_id')
+        if event_id:
+            with REDIS_SECONDS.time(op='seen_mark'):
+                await self.db.set(f'{self.prefix}{event_id}', 1, ex=self.ttl)
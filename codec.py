@@ -0,0 +1,23 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = 'orjson' if orjson else 'json'
+
+
+def loads(data):
+    """Разбирает JSON из bytes или str: orjson, если установлен, иначе stdlib json"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> str:
+    """Сериализует в JSON-строку без экранирования не-ASCII символов"""
+    if orjson:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False)
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Раздает события пулу asyncio-воркеров по ключу (from_id).
+
+    События одного пользователя всегда попадают в одну и ту же очередь
+    и обрабатываются строго по порядку, события разных пользователей -
+    параллельно. Очереди ограничены по размеру: когда очередь заполнена,
+    dispatch ждет, и цикл long-poll не забирает новые события.
+    """
+
+    def __init__(self, handler, workers: int = 8, queue_size: int = 100):
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues = []
+        self._tasks = []
+
+    async def start(self):
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def dispatch(self, key: int, *args):
+        """
+        Ставит вызов handler(*args) в очередь воркера, закрепленного за key.
+        Возвращает future, который завершается после обработки.
+        """
+        queue = self._queues[hash(key) % self.workers]
+        done = asyncio.get_running_loop().create_future()
+        await queue.put((args, done))
+        return done
+
+    async def join(self):
+        for queue in self._queues:
+            await queue.join()
+
+    async def close(self):
+        await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            args, done = await queue.get()
+            try:
+                await self.handler(*args)
+            except Exception as err:
+                logger.exception(err)
+            finally:
+                if not done.done():
+                    done.set_result(None)
+                queue.task_done()
+
+
+class ThreadDispatcher:
+    """
+    Синхронный аналог Dispatcher для longpoll.py на ThreadPoolExecutor.
+
+    За каждым из workers потоков закреплена своя однопоточная очередь,
+    события одного пользователя выполняются в ней по порядку. Когда
+    в обработке queue_size событий на поток, dispatch блокируется.
+    """
+
+    def __init__(self, handler, workers: int = 8, queue_size: int = 100):
+        self.handler = handler
+        self.workers = workers
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'handler-{i}')
+            for i in range(workers)
+        ]
+        self._slots = threading.BoundedSemaphore(workers * queue_size)
+
+    def dispatch(self, key: int, *args):
+        """Ставит вызов handler(*args) в поток, закрепленный за key, и возвращает Future"""
+        self._slots.acquire()
+        executor = self._executors[hash(key) % self.workers]
+        return executor.submit(self._run, args)
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+
+    def _run(self, args):
+        try:
+            self.handler(*args)
+        except Exception as err:
+            logger.exception(err)
+        finally:
+            self._slots.release()
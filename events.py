@@ -0,0 +1,89 @@
+import codec
+
+
+START_COMMANDS = frozenset(('start', '/start', 'начать', 'старт', '+'))
+
+
+class IncomingMessage:
+    """
+    Событие message_new, разобранное один раз при получении: дальше
+    обработчики работают с полями, а не с вложенным словарем события.
+
+    text - текст в нижнем регистре без пробелов по краям,
+    payload - разобранный payload кнопки (пустой словарь, если его нет),
+    event - исходное событие, нужно для event_id и записи в потоки.
+    """
+
+    type = 'message_new'
+    __slots__ = ('user_id', 'peer_id', 'text', 'raw_text', 'payload', 'supports_callback', 'event_id', 'event')
+
+    def __init__(self, event: dict):
+        message = event['object']['message']
+        self.user_id: int = message['from_id']
+        self.peer_id: int = message.get('peer_id', self.user_id)
+        self.raw_text: str = message.get('text', '')
+        self.text: str = self.raw_text.lower().strip()
+        self.payload: dict = codec.loads(message['payload']) if message.get('payload') else {}
+        client_info = event['object'].get('client_info') or {}
+        self.supports_callback: bool = 'callback' in client_info.get('button_actions', ())
+        self.event_id: str = event.get('event_id')
+        self.event = event
+
+    def __repr__(self):
+        return f'IncomingMessage(user_id={self.user_id}, text={self.text!r}, payload={self.payload!r})'
+
+    @property
+    def button(self):
+        return self.payload.get('button')
+
+    @property
+    def is_start(self) -> bool:
+        return self.text in START_COMMANDS or self.button == 'start'
+
+
+class IncomingCallback:
+    """
+    Событие message_event - нажатие callback-кнопки.
+
+    callback_id нужен для ответа messages.sendMessageEventAnswer,
+    conversation_message_id - для messages.edit сообщения с кнопкой.
+    """
+
+    type = 'message_event'
+    __slots__ = ('user_id', 'peer_id', 'payload', 'callback_id', 'conversation_message_id', 'event_id', 'event')
+
+    def __init__(self, event: dict):
+        data = event['object']
+        self.user_id: int = data['user_id']
+        self.peer_id: int = data.get('peer_id', self.user_id)
+        self.payload: dict = data.get('payload') or {}
+        self.callback_id: str = data['event_id']
+        self.conversation_message_id: int = data.get('conversation_message_id')
+        self.event_id: str = event.get('event_id')
+        self.event = event
+
+    def __repr__(self):
+        return f'IncomingCallback(user_id={self.user_id}, payload={self.payload!r})'
+
+    @property
+    def button(self):
+        return self.payload.get('button')
+
+
+EVENT_TYPES = {
+    IncomingMessage.type: IncomingMessage,
+    IncomingCallback.type: IncomingCallback,
+}
+
+
+def parse_event(event: dict):
+    """IncomingMessage или IncomingCallback для обрабатываемых событий, иначе None"""
+    event_class = EVENT_TYPES.get(event.get('type'))
+    return event_class(event) if event_class else None
+
+
+def event_user_id(event: dict):
+    """id пользователя события без полного разбора"""
+    if event['type'] == IncomingCallback.type:
+        return event['object']['user_id']
+    return event['object']['message']['from_id']
@@ -1,30 +1,61 @@
+import os
 import requests
-import random
 import redis
-import json
+import logging
 
-from pprint import pprint
 from environs import Env
 from textwrap import dedent
 from time import sleep
 
+import codec
+
+from buttons import START_KEYBOARD, MENU_KEYBOARDS
+from dispatcher import ThreadDispatcher
+from events import IncomingMessage
+from metrics import HANDLER_SECONDS, log_sampled
+from outbox import event_scope, next_random_id
+from storage import SyncStateStore
+
+
+logger = logging.getLogger(__name__)
+
+API_URL = os.environ.get('VK_API_URL', 'https://api.vk.com/method/')
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """Session с пулом keep-alive соединений на pool_size потоков"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Отдельные сессии для ожидания long poll и для вызовов методов API
+poll_session = make_session(1)
+api_session = make_session()
+
+
+def configure_sessions(pool_size: int):
+    global api_session
+    api_session.close()
+    api_session = make_session(pool_size)
+
 
 def get_long_poll_server(token: str, group_id: int, /):
-    get_album_photos_url = 'https://api.vk.com/method/groups.getLongPollServer'
+    get_album_photos_url = f'{API_URL}groups.getLongPollServer'
     params = {'access_token': token, 'v': '5.131', 'group_id': group_id}
-    response = requests.get(get_album_photos_url, params=params)
+    response = api_session.get(get_album_photos_url, params=params)
     response.raise_for_status()
-    key = response.json()['response']['key']
-    server = response.json()['response']['server']
-    ts = response.json()['response']['ts']
-    return key, server, ts
+    response = codec.loads(response.content)['response']
+    return response['key'], response['server'], response['ts']
 
 
 def connect_server(key, server, ts):
     params = {'act': 'a_check', 'key': key, 'ts': ts, 'wait': 25}
-    response = requests.get(server, params=params)
+    response = poll_session.get(server, params=params, timeout=params['wait'] + 10)
     response.raise_for_status()
-    return response.json()
+    return codec.loads(response.content)
 
 
 def send_message(
@@ -38,11 +69,11 @@ def send_message(
         lat: str = None,
         long: str = None
 ):
-    send_message_url = 'https://api.vk.com/method/messages.send'
+    send_message_url = f'{API_URL}messages.send'
     params = {
         'access_token': token, 'v': '5.131',
         'user_id': user_id,
-        'random_id': random.randint(0, 1000),
+        'random_id': next_random_id(),
         'message': message,
         'attachment': attachment,
         'keyboard': keyboard,
@@ -51,35 +82,36 @@ def send_message(
         'lat': lat,
         'long': long
     }
-    response = requests.post(send_message_url, params=params)
+    response = api_session.post(send_message_url, params=params)
     response.raise_for_status()
-    return response.json()
+    return codec.loads(response.content)
 
 
 def get_user(token: str, user_ids: str):
-    get_users_url = 'https://api.vk.com/method/users.get'
+    get_users_url = f'{API_URL}users.get'
     params = {
         'access_token': token, 'v': '5.131',
         'user_ids': user_ids
     }
-    response = requests.get(get_users_url, params=params)
+    response = api_session.get(get_users_url, params=params)
     response.raise_for_status()
-    return response.json().get('response')
+    return codec.loads(response.content).get('response')
 
 
-def event_handler(token: str, event: dict, db: redis.Redis):
+def event_handler(token: str, message: IncomingMessage, db: SyncStateStore):
     """Главный обработчик событий"""
 
-    user_id = event['object']['message']['from_id']
-    start_buttons = ['start', '/start', 'начать', 'старт', '+']
-    text = event['object']['message']['text'].lower().strip()
-    payload = json.loads(event['object']['message'].get('payload', '{}'))
-    if not db.get(f'{user_id}_first_name'):
+    user_id = message.user_id
+    stored_state, user_info = db.load(user_id)
+    new_user_info = None
+    if not user_info:
         user_data = get_user(token, user_id)
         if user_data:
-            db.set(f'{user_id}_first_name', user_data[0].get('first_name'))
-            db.set(f'{user_id}_last_name', user_data[0].get('last_name'))
-    if text in start_buttons or payload.get('button') == 'start':
+            new_user_info = {
+                'first_name': user_data[0].get('first_name'),
+                'last_name': user_data[0].get('last_name')
+            }
+    if message.is_start:
         user_state = 'START'
         msg = f'''
             Привет, я бот этого чата.
@@ -87,98 +119,80 @@ def event_handler(token: str, event: dict, db: redis.Redis):
             Для записи на курс нажмите:
             "Предстоящие курсы"             
             '''
-        button = [
-            [
-                {
-                    'action': {'type': 'text', 'payload': {'button': 'start'}, 'label': '☰ MENU'},
-                    'color': 'positive'
-                }
-            ]
-        ]
-        keyboard = {'inline': False, 'buttons': button}
         send_message(
             token=token,
             user_id=user_id,
             message=dedent(msg),
-            keyboard=json.dumps(keyboard, ensure_ascii=False)
+            keyboard=MENU_KEYBOARDS[('positive', False)]
         )
     else:
-        user_state = db.get(user_id).decode("utf-8")
-        print(user_state)
-
-    states_functions = {
-        'START': start,
-        'MAIN_MENU': main_menu_handler,
-        # 'COURSE': handle_course_info,
-        # 'PHONE': enter_phone,
-    }
-    state_handler = states_functions[user_state]
-    next_state = state_handler(token, event, db)
-    db.set(user_id, next_state)
-
-
-def start(token: str, event: dict, db: redis.Redis):
-    user_id = event['object']['message']['from_id']
-    start_buttons = [
-        ('Предстоящие курсы', 'future_courses'),
-        ('Ваши курсы', 'client_courses'),
-        ('Прошедшие курсы', 'past_courses'),
-        ('Написать администратору', 'admin_msg'),
-        ('Как нас найти', 'search_us')
-    ]
-    buttons = []
-    for label, payload in start_buttons:
-        buttons.append(
-            [
-                {
-                    'action': {'type': 'text', 'payload': {'button': payload}, 'label': label},
-                    'color': 'secondary'
-                }
-            ],
-        )
-    keyboard = {'inline': True, 'buttons': buttons}
+        user_state = stored_state or 'START'
+
+    state_handler = STATE_HANDLERS[user_state]
+    with HANDLER_SECONDS.time(state=user_state):
+        next_state = state_handler(token, message, db)
+    db.save(user_id, next_state, profile=new_user_info)
+
 
+def handle_update(token: str, message: IncomingMessage, db: SyncStateStore):
+    with event_scope(message.event_id):
+        event_handler(token, message, db)
+
+
+def start(token: str, message: IncomingMessage, db: SyncStateStore):
     send_message(
         token=token,
-        user_id=user_id,
+        user_id=message.user_id,
         message='MENU:',
-        keyboard=json.dumps(keyboard, ensure_ascii=False)
+        keyboard=START_KEYBOARD
     )
     return 'MAIN_MENU'
 
 
-def main_menu_handler(token: str, event: dict, db: redis.Redis):
-    if event['object']['message'].get('payload'):
-        print(event['object']['message'].get('payload'))
-        # return send_main_menu_answer(token, event, db)
+def main_menu_handler(token: str, message: IncomingMessage, db: SyncStateStore):
+    if message.payload:
+        log_sampled(logger, 'payload', payload=message.payload)
+        # return send_main_menu_answer(token, message, db)
     else:
-        print(event['object']['message']['text'])
-        # return answer_arbitrary_text(token, event, db)
+        log_sampled(logger, 'arbitrary text', text=message.raw_text)
+        # return answer_arbitrary_text(token, message, db)
     return 'START'
 
 
-def listen_server(token: str, group_id: int, db: redis.Redis, /):
+# Обработчики состояний, собираются один раз при импорте
+STATE_HANDLERS = {
+    'START': start,
+    'MAIN_MENU': main_menu_handler,
+    # 'COURSE': handle_course_info,
+    # 'PHONE': enter_phone,
+}
+
+
+def listen_server(token: str, group_id: int, db: SyncStateStore, /, *, workers: int = 8):
+    dispatcher = ThreadDispatcher(handle_update, workers=workers)
     key, server, ts = get_long_poll_server(token, group_id)
     while True:
         try:
             response = connect_server(key, server, ts)
             ts = response['ts']
             events = response['updates']
-            pprint(events)
+            log_sampled(logger, 'updates', count=len(events), ts=ts)
             for event in events:
                 if event['type'] != 'message_new':
                     continue
-                event_handler(token, event, db)
+                message = IncomingMessage(event)
+                dispatcher.dispatch(message.user_id, token, message, db)
         except ConnectionError as err:
             sleep(5)
             continue
         except requests.exceptions.ReadTimeout as err:
             continue
         except Exception as err:
-            print(err)
+            logger.exception(err)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     env = Env()
     env.read_env()
     redis_password = env.str('REDIS_PASSWORD')
@@ -187,4 +201,6 @@ if __name__ == '__main__':
     redis_db = redis.Redis(host=redis_host, port=redis_port, password=redis_password)
     TOKEN = env.str('TOKEN')
     GROUP_ID = env.int('GROUP_ID')
-    listen_server(TOKEN, GROUP_ID, redis_db)
+    WORKERS = env.int('WORKERS', 8)
+    configure_sessions(WORKERS)
+    listen_server(TOKEN, GROUP_ID, SyncStateStore(redis_db), workers=WORKERS)
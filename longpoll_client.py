@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import random
+import aiohttp
+
+from time import monotonic
+
+import codec
+
+from metrics import LONGPOLL_ERRORS, LONGPOLL_SECONDS, LONGPOLL_UPDATES
+from vk_api import VkApiError, request_method
+
+
+logger = logging.getLogger(__name__)
+
+
+class LongPollClient:
+    """
+    Клиент Bots Long Poll API, который сам хранит key, server и ts.
+
+    failed=1 - берется новый ts из ответа, failed=2 - запрашивается только
+    новый key, failed=3 - новые key и ts. Таймаут ожидания a_check - обычная
+    ситуация для long poll, запрос повторяется сразу. При сетевых ошибках,
+    ошибках API и таймаутах groups.getLongPollServer запрос повторяется с экспоненциальной задержкой со случайным
+    разбросом, key и server при этом не перезапрашиваются, пока сервер
+    сам не сообщит, что они устарели. Переданный ts используется
+    для возобновления с сохраненной позиции. Запросы a_check идут
+    через poll_session, если она задана, остальные - через session.
+    """
+
+    def __init__(
+            self,
+            session: aiohttp.ClientSession,
+            token: str,
+            group_id: int,
+            ts: str = None,
+            wait: int = 25,
+            backoff_base: float = 0.5,
+            backoff_max: float = 30,
+            poll_session: aiohttp.ClientSession = None,
+    ):
+        self.session = session
+        self.poll_session = poll_session or session
+        self.token = token
+        self.group_id = group_id
+        self.wait = wait
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.key = None
+        self.server = None
+        self.ts = ts
+        self.failed = {1: 0, 2: 0, 3: 0}
+        self.timeouts = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.downtime = 0.0
+        self.last_error = None
+        self._down_since = None
+
+    def stats(self):
+        return {
+            'failed': dict(self.failed),
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'reconnects': self.reconnects,
+            'downtime': self.downtime + (monotonic() - self._down_since if self._down_since else 0),
+            'last_error': repr(self.last_error) if self.last_error else None,
+        }
+
+    async def refresh(self, update_ts: bool = True):
+        """Запрашивает новый key (и server), при update_ts - также новый ts"""
+        response = await request_method(
+            self.session, self.token, 'groups.getLongPollServer', {'group_id': self.group_id}, group_id=self.group_id
+        )
+        self.key = response['key']
+        self.server = response['server']
+        if update_ts or self.ts is None:
+            self.ts = response['ts']
+
+    async def check(self):
+        """Один запрос a_check: возвращает список событий, обрабатывая failed"""
+        if self.key is None:
+            await self.refresh(update_ts=False)
+        params = {'act': 'a_check', 'key': self.key, 'ts': self.ts, 'wait': self.wait}
+        # общий total сессии API короче wait, поэтому ограничиваются только подключение и чтение
+        timeout = aiohttp.ClientTimeout(total=None, connect=5, sock_read=self.wait + 10)
+        try:
+            with LONGPOLL_SECONDS.time(group_id=self.group_id):
+                async with self.poll_session.get(self.server, params=params, timeout=timeout) as res:
+                    res.raise_for_status()
+                    response = codec.loads(await res.read())
+        except asyncio.TimeoutError:
+            # сервер не ответил за время ожидания - событий нет
+            self.timeouts += 1
+            LONGPOLL_ERRORS.inc(kind='timeout', group_id=self.group_id)
+            return []
+        failed = response.get('failed')
+        if failed:
+            LONGPOLL_ERRORS.inc(kind=f'failed_{failed}', group_id=self.group_id)
+            self.failed[failed] = self.failed.get(failed, 0) + 1
+            if failed == 1:
+                self.ts = response['ts']
+            elif failed == 2:
+                await self.refresh(update_ts=False)
+            else:
+                await self.refresh()
+            return []
+        self.ts = response['ts']
+        return response.get('updates', [])
+
+    async def listen(self):
+        """Бесконечно отдает непустые пачки событий, переживая ошибки соединения"""
+        attempt = 0
+        while True:
+            try:
+                updates = await self.check()
+            except (aiohttp.ClientError, ConnectionError, VkApiError, asyncio.TimeoutError) as err:
+                self.errors += 1
+                LONGPOLL_ERRORS.inc(kind='error', group_id=self.group_id)
+                self.last_error = err
+                if self._down_since is None:
+                    self._down_since = monotonic()
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1)
+                attempt += 1
+                logger.warning(f'Ошибка long poll: {err!r}, повтор через {delay:.1f} с')
+                await asyncio.sleep(delay)
+                continue
+            if self._down_since is not None:
+                self.downtime += monotonic() - self._down_since
+                self.reconnects += 1
+                self._down_since = None
+                attempt = 0
+            if updates:
+                LONGPOLL_UPDATES.observe(len(updates), group_id=self.group_id)
+                yield updates
@@ -0,0 +1,185 @@
+import logging
+import os
+import random
+import threading
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import monotonic
+from aiohttp import web
+
+import codec
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+
+
+def _label_key(labels: dict):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, registry, name: str, help: str):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.emit(self.kind, self.name, labels, amount)
+
+    def render(self):
+        for key, value in self.values.items():
+            yield f'{self.name}{_format_labels(key)} {value}'
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, registry, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self.registry.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+        self.registry.emit(self.kind, self.name, labels, value)
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - started_at, **labels)
+
+    def render(self):
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(key)} {total}'
+            yield f'{self.name}_count{_format_labels(key)} {cumulative}'
+
+
+class Registry:
+    """
+    Набор метрик с выводом в формате Prometheus.
+
+    Sinks получают каждое изменение как (kind, name, labels, value), например
+    для пересылки в StatsD. Collectors вызываются при выводе и возвращают
+    текущие значения [(name, labels, value)] - так публикуются stats()
+    очередей, кэшей и соединений.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.sinks = []
+        self.collectors = []
+
+    def counter(self, name: str, help: str):
+        return self.metrics.setdefault(name, Counter(self, name, help))
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(self, name, help, buckets))
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        self.collectors.remove(collector)
+
+    def emit(self, kind, name, labels, value):
+        for sink in self.sinks:
+            sink(kind, name, labels, value)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for metric in self.metrics.values():
+                lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+                lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                if isinstance(value, (int, float)):
+                    lines.append(f'{name}{_format_labels(_label_key(labels))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+LONGPOLL_SECONDS = REGISTRY.histogram('vk_longpoll_request_seconds', 'Длительность запроса a_check')
+LONGPOLL_UPDATES = REGISTRY.histogram(
+    'vk_longpoll_updates', 'Событий в одном ответе long poll', buckets=(1, 2, 5, 10, 20, 50, 100, 1000)
+)
+LONGPOLL_ERRORS = REGISTRY.counter('vk_longpoll_errors_total', 'Ошибки и ответы failed long poll')
+HANDLER_SECONDS = REGISTRY.histogram('vk_handler_seconds', 'Длительность обработчика состояния')
+API_SECONDS = REGISTRY.histogram('vk_api_request_seconds', 'Длительность запроса к методу API')
+API_ERRORS = REGISTRY.counter('vk_api_errors_total', 'Ошибки методов API')
+REDIS_SECONDS = REGISTRY.histogram('vk_redis_seconds', 'Длительность операций с Redis')
+OUTBOX_RETRIES = REGISTRY.counter('vk_outbox_retries_total', 'Повторные отправки из outbox')
+OUTBOX_DROPPED = REGISTRY.counter('vk_outbox_dropped_total', 'Вызовы, не отправленные после всех попыток')
+
+
+def stats_collector(prefix: str, stats, **labels):
+    """Collector, публикующий числовые поля stats() как метрики prefix_<поле>"""
+
+    def collect():
+        for name, value in stats().items():
+            if isinstance(value, dict):
+                for sub_name, sub_value in value.items():
+                    yield f'{prefix}_{name}', dict(labels, key=sub_name), sub_value
+            else:
+                yield f'{prefix}_{name}', labels, value
+
+    return collect
+
+
+async def start_metrics_server(port: int, host: str = '0.0.0.0', registry: Registry = REGISTRY):
+    """Поднимает HTTP-сервер с метриками на /metrics"""
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def log_sampled(logger: logging.Logger, message: str, rate: float = None, **fields):
+    """Пишет структурированную запись в лог только для доли rate вызовов"""
+    rate = LOG_SAMPLE_RATE if rate is None else rate
+    if rate >= 1 or random.random() < rate:
+        logger.info(f'{message} {codec.dumps(fields)}')
@@ -0,0 +1,167 @@
+"""
+Несколько сообществ в одном процессе.
+
+    GROUPS_FILE=groups.json python multigroup.py
+
+groups.json - список сообществ, необязательные поля переопределяют
+общие настройки из переменных окружения:
+    [
+        {"group_id": 1, "token": "...", "send_rate": 20, "workers": 4},
+        {"group_id": 2, "token": "..."}
+    ]
+
+Все сообщества используют общие пулы соединений, клиент Redis и очередь
+отправки; у каждого свой long poll, свои обработчики, свой лимит запросов
+в общей очереди и свои метрики с меткой group_id. Ошибка одного сообщества,
+в том числе при запуске, перезапускает только его.
+"""
+import asyncio
+import json
+import logging
+import redis.asyncio
+
+from environs import Env
+
+from async_longpoll import (
+    close_connect, connect_options, create_connect, create_redis, handle_update, process_updates,
+    register_group_collectors, register_shared_collectors,
+)
+from checkpoint import TsCheckpoint
+from dispatcher import Dispatcher
+from longpoll_client import LongPollClient
+from metrics import REGISTRY, start_metrics_server
+from scheduler import OutboundScheduler
+from transport import Transports
+from vk_api import is_rate_limit_error
+
+
+logger = logging.getLogger(__name__)
+
+GROUP_RESTARTS = REGISTRY.counter('vk_group_restarts_total', 'Перезапуски цикла сообщества после ошибки')
+
+
+def load_groups(env: Env):
+    """Список настроек сообществ из файла GROUPS_FILE или JSON в GROUPS"""
+    path = env.str('GROUPS_FILE', '')
+    if path:
+        with open(path, encoding='utf-8') as file:
+            groups = json.load(file)
+    else:
+        groups = json.loads(env.str('GROUPS'))
+    if not groups:
+        raise ValueError('Не задано ни одного сообщества')
+    for number, group in enumerate(groups):
+        missing = [field for field in ('group_id', 'token') if not group.get(field)]
+        if missing:
+            raise ValueError(f'Сообщество №{number + 1} в списке: не задано {", ".join(missing)}')
+    return groups
+
+
+async def run_group(
+        transports: Transports,
+        redis_db: redis.asyncio.Redis,
+        scheduler: OutboundScheduler,
+        config: dict,
+        options: dict,
+        /, *,
+        workers: int = 4,
+        queue_size: int = 100,
+        restart_delay: float = 1,
+        restart_delay_max: float = 300,
+):
+    """
+    Long poll и обработчики одного сообщества с перезапуском после ошибок.
+    После ошибки, в том числе при запуске (например, Redis недоступен),
+    все объекты сообщества закрываются и создаются заново.
+    workers и queue_size - значения по умолчанию, если их нет в config.
+    """
+    group_id = config['group_id']
+    options = dict(options, send_rate=config.get('send_rate', options['send_rate']))
+    delay = restart_delay
+    while True:
+        try:
+            dispatcher = Dispatcher(
+                handle_update,
+                workers=config.get('workers', workers),
+                queue_size=config.get('queue_size', queue_size)
+            )
+            await dispatcher.start()
+            connect = checkpoint = None
+            collectors = []
+            try:
+                connect = await create_connect(
+                    transports, config['token'], redis_db, group_id, **options,
+                    scheduler=scheduler, state_prefix=config.get('state_prefix', f'{group_id}:')
+                )
+                checkpoint = TsCheckpoint(redis_db, f'vk_longpoll:{group_id}:ts')
+                client = LongPollClient(
+                    transports.api, config['token'], group_id,
+                    ts=await checkpoint.load(), wait=transports.wait, poll_session=transports.poll
+                )
+                collectors = register_group_collectors(connect, dispatcher, client, group_id=group_id)
+                async for events in client.listen():
+                    await process_updates(connect, dispatcher, checkpoint, events, client.ts)
+                    delay = restart_delay
+            finally:
+                for collector in collectors:
+                    REGISTRY.remove_collector(collector)
+                await dispatcher.close()
+                if checkpoint is not None:
+                    await checkpoint.flush()
+                if connect is not None:
+                    await close_connect(connect)
+        except Exception as err:
+            GROUP_RESTARTS.inc(group_id=group_id)
+            logger.exception(f'Сообщество {group_id}: {err}, перезапуск через {delay:.0f} с')
+            await asyncio.sleep(delay)
+            delay = min(restart_delay_max, delay * 2)
+
+
+async def supervise(transports, redis_db, scheduler, config, options, **kwargs):
+    """Сообщество с ошибкой в настройках не останавливает остальные"""
+    try:
+        await run_group(transports, redis_db, scheduler, config, options, **kwargs)
+    except Exception as err:
+        logger.exception(f'Сообщество {config.get("group_id")} остановлено: {err}')
+
+
+async def serve():
+    env = Env()
+    env.read_env()
+    groups = load_groups(env)
+    options = connect_options(env)
+    redis_db = create_redis(env)
+    # общий лимит по умолчанию - сумма лимитов сообществ
+    total_rate = sum(group.get('send_rate', options['send_rate']) for group in groups)
+    scheduler = OutboundScheduler(
+        rate=env.float('TOTAL_SEND_RATE', total_rate),
+        queue_size=options['send_queue_size'] * len(groups),
+        concurrency=env.int('SEND_CONCURRENCY', 10 * len(groups)),
+        retry_on=is_rate_limit_error
+    )
+    await scheduler.start()
+    transports = Transports(
+        api_limit=env.int('API_CONNECTIONS', 100),
+        poll_limit=len(groups) + 1,
+        dns_ttl=env.int('DNS_CACHE_TTL', 300)
+    )
+    async with transports:
+        register_shared_collectors({'scheduler': scheduler, 'transports': transports})
+        metrics_port = env.int('METRICS_PORT', 0)
+        if metrics_port:
+            await start_metrics_server(metrics_port)
+        try:
+            await asyncio.gather(*(
+                supervise(
+                    transports, redis_db, scheduler, group, options,
+                    workers=env.int('WORKERS', 4), queue_size=env.int('QUEUE_SIZE', 100)
+                )
+                for group in groups
+            ))
+        finally:
+            await scheduler.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve())
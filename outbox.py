@@ -0,0 +1,214 @@
+import asyncio
+import contextvars
+import hashlib
+import itertools
+import logging
+import random
+import aiohttp
+
+from contextlib import contextmanager
+from time import monotonic, time
+
+import codec
+
+from metrics import OUTBOX_DROPPED, OUTBOX_RETRIES, REDIS_SECONDS
+from scheduler import PRIORITY_INTERACTIVE
+from vk_api import VkApiError, call_method, is_rate_limit_error
+
+
+logger = logging.getLogger(__name__)
+
+# 1 - неизвестная ошибка, 10 - внутренняя ошибка сервера
+TRANSIENT_ERRORS = {1, 10}
+
+_current_event = contextvars.ContextVar('current_event', default=None)
+
+
+@contextmanager
+def event_scope(event_id: str):
+    """
+    Внутри блока random_id исходящих сообщений вычисляются из event_id
+    и порядкового номера сообщения, поэтому повторная обработка того же
+    события дает те же random_id и VK не отправляет ответ второй раз.
+    """
+    token = _current_event.set((event_id, itertools.count()) if event_id else None)
+    try:
+        yield
+    finally:
+        _current_event.reset(token)
+
+
+def next_random_id():
+    """random_id следующего сообщения: из текущего события или случайный"""
+    scope = _current_event.get()
+    if scope is None:
+        return random.getrandbits(31)
+    event_id, counter = scope
+    digest = hashlib.blake2b(f'{event_id}:{next(counter)}'.encode('utf-8'), digest_size=4).digest()
+    return int.from_bytes(digest, 'big') & 0x7fffffff
+
+
+def is_transient_error(err: Exception):
+    if isinstance(err, VkApiError):
+        return is_rate_limit_error(err) or err.code in TRANSIENT_ERRORS
+    return isinstance(err, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class Outbox:
+    """
+    Надежная отправка сообщений.
+
+    Перед отправкой вызов записывается в Redis-хэш key под полем
+    {random_id}:{peer}, после успешной отправки или окончательной ошибки
+    удаляется. При временной ошибке вызов повторяется в фоне с
+    экспоненциальной задержкой и тем же random_id, поэтому повтор
+    не может продублировать сообщение. Записи, оставшиеся от упавшего
+    процесса и не обновлявшиеся stale_after секунд, забирает и отправляет
+    заново периодическая проверка любого процесса.
+
+    Число записей в хэше всех процессов (HLEN) обновляется раз в
+    depth_interval секунд и публикуется в stats() как depth.
+    """
+
+    def __init__(
+            self,
+            connect,
+            key: str,
+            max_attempts: int = 8,
+            base_delay: float = 1,
+            max_delay: float = 300,
+            stale_after: float = 600,
+            depth_interval: float = 15,
+    ):
+        self.connect = connect
+        self.db = connect['redis_db']
+        self.key = key
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stale_after = stale_after
+        self.depth_interval = depth_interval
+        self.redis_depth = None
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.recovered = 0
+        self._pending = set()
+        self._retries = set()
+        self._worker = None
+        self._stopped = asyncio.Event()
+
+    async def start(self):
+        self._stopped.clear()
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает фоновые повторы; неотправленные вызовы остаются в Redis"""
+        self._stopped.set()
+        tasks = list(self._retries)
+        for task in tasks:
+            task.cancel()
+        # проверку не отменяем: отмена посреди команды Redis может потеряться, и close зависнет
+        if self._worker is not None:
+            tasks.append(self._worker)
+            self._worker = None
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'recovered': self.recovered,
+            'pending': len(self._pending),
+            'retrying': len(self._retries),
+            'depth': self.redis_depth,
+        }
+
+    async def depth(self):
+        """Число неотправленных вызовов всех процессов"""
+        return await self.db.hlen(self.key)
+
+    async def send(self, method: str, params: dict, priority: int = PRIORITY_INTERACTIVE):
+        """
+        Отправляет вызов и возвращает ответ. При временной ошибке возвращает
+        None, а вызов повторяется в фоне; остальные ошибки поднимаются.
+        """
+        params.setdefault('random_id', next_random_id())
+        field = f'{params["random_id"]}:{params.get("user_id") or params.get("peer_id")}'
+        entry = {'method': method, 'params': params, 'priority': priority, 'attempt': 0, 'updated_at': time()}
+        with REDIS_SECONDS.time(op='outbox_put'):
+            await self.db.hset(self.key, field, codec.dumps(entry))
+        self._pending.add(field)
+        return await self._attempt(field, entry)
+
+    async def _attempt(self, field, entry):
+        try:
+            response = await call_method(self.connect, entry['method'], entry['params'], priority=entry['priority'])
+        except Exception as err:
+            entry['attempt'] += 1
+            if is_transient_error(err) and entry['attempt'] < self.max_attempts:
+                self._schedule_retry(field, entry)
+                return None
+            self.dropped += 1
+            OUTBOX_DROPPED.inc(method=entry['method'])
+            await self._done(field)
+            raise
+        self.sent += 1
+        await self._done(field)
+        return response
+
+    async def _done(self, field):
+        self._pending.discard(field)
+        with REDIS_SECONDS.time(op='outbox_done'):
+            await self.db.hdel(self.key, field)
+
+    def _schedule_retry(self, field, entry):
+        task = asyncio.create_task(self._retry(field, entry))
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+
+    async def _retry(self, field, entry):
+        delay = min(self.max_delay, self.base_delay * 2 ** (entry['attempt'] - 1))
+        await asyncio.sleep(delay * random.uniform(0.5, 1))
+        self.retried += 1
+        OUTBOX_RETRIES.inc(method=entry['method'])
+        entry['updated_at'] = time()
+        try:
+            await self.db.hset(self.key, field, codec.dumps(entry))
+            await self._attempt(field, entry)
+        except Exception as err:
+            logger.warning(f'{entry["method"]} не отправлен после {entry["attempt"]} попыток: {err}')
+
+    async def recover(self):
+        """Забирает записи, не обновлявшиеся stale_after секунд, и отправляет их заново"""
+        deadline = time() - self.stale_after
+        async for field, value in self.db.hscan_iter(self.key, count=500):
+            entry = codec.loads(value)
+            if entry['updated_at'] > deadline:
+                continue
+            # HDEL вернет 1 только одному из процессов, проверяющих outbox
+            if not await self.db.hdel(self.key, field):
+                continue
+            self.recovered += 1
+            field = field.decode('utf-8') if isinstance(field, bytes) else field
+            entry['updated_at'] = time()
+            await self.db.hset(self.key, field, codec.dumps(entry))
+            self._pending.add(field)
+            self._schedule_retry(field, entry)
+
+    async def _run(self):
+        recovered_at = None
+        while not self._stopped.is_set():
+            try:
+                if recovered_at is None or monotonic() - recovered_at >= self.stale_after / 2:
+                    recovered_at = monotonic()
+                    await self.recover()
+                with REDIS_SECONDS.time(op='outbox_depth'):
+                    self.redis_depth = await self.depth()
+            except Exception as err:
+                logger.exception(err)
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.depth_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+from time import monotonic
+
+from more_itertools import chunked
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileResolver:
+    """
+    Имена пользователей с тремя уровнями: локальный LRU/TTL-кэш,
+    ключи {user_id}_first_name в Redis и users.get.
+
+    Промахи, накопленные за window секунд, объединяются: профили
+    читаются из Redis одним MGET, недостающие запрашиваются одним
+    users.get на batch_size id. Одновременные запросы одного
+    пользователя ждут один и тот же результат. При ошибке запроса
+    resolve возвращает None, как раньше get_user.
+    """
+
+    def __init__(
+            self,
+            fetch_users,
+            store,
+            window: float = 0.05,
+            batch_size: int = 1000,
+            cache_size: int = 10000,
+            ttl: float = 3600,
+    ):
+        self.fetch_users = fetch_users
+        self.store = store
+        self.window = window
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._batch = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'api_calls': self.api_calls,
+            'cached': len(self._cache),
+        }
+
+    def remember(self, user_id, profile):
+        self._cache[user_id] = (monotonic() + self.ttl, profile)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def forget(self, user_id):
+        self._cache.pop(user_id, None)
+
+    def _cached(self, user_id):
+        cached = self._cache.get(user_id)
+        if cached is None:
+            return None
+        expires_at, profile = cached
+        if expires_at < monotonic():
+            del self._cache[user_id]
+            return None
+        self._cache.move_to_end(user_id)
+        return profile
+
+    async def resolve(self, user_id):
+        """Возвращает {'first_name': ..., 'last_name': ...} или None"""
+        profile = self._cached(user_id)
+        if profile is not None:
+            self.hits += 1
+            return profile
+        self.misses += 1
+        future = self._inflight.get(user_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[user_id] = future
+            self._enqueue(user_id)
+        return await asyncio.shield(future)
+
+    def _enqueue(self, user_id):
+        self._batch.append(user_id)
+        if len(self._batch) >= self.batch_size:
+            if self._flush_handle:
+                self._flush_handle.cancel()
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        batch, self._batch = self._batch, []
+        task = asyncio.create_task(self._flush(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch):
+        profiles = {}
+        try:
+            profiles.update(await self.store.load_profiles(batch))
+            missing = [user_id for user_id in batch if user_id not in profiles]
+            for user_ids in chunked(missing, self.batch_size):
+                self.api_calls += 1
+                users = await self.fetch_users(','.join(map(str, user_ids))) or []
+                fetched = {
+                    user['id']: {'first_name': user.get('first_name'), 'last_name': user.get('last_name')}
+                    for user in users
+                }
+                if fetched:
+                    await self.store.save_profiles(fetched)
+                    profiles.update(fetched)
+        except Exception as err:
+            logger.exception(err)
+        for user_id in batch:
+            profile = profiles.get(user_id)
+            if profile:
+                self.remember(user_id, profile)
+            future = self._inflight.pop(user_id)
+            if not future.done():
+                future.set_result(profile)
@@ -0,0 +1,213 @@
+import asyncio
+import itertools
+import logging
+
+from collections import defaultdict, deque
+from time import monotonic
+
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+
+class TokenBucket:
+    """Token bucket: rate запросов в секунду с запасом burst"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated_at = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> float:
+        """Берет токен без ожидания: 0, если получилось, иначе сколько секунд ждать"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self):
+        """Сбрасывает накопленный запас, например после ошибки лимита от VK"""
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+
+
+class OutboundScheduler:
+    """
+    Очередь исходящих запросов к API с приоритетами и ограничением частоты.
+
+    submit ставит вызов в очередь и ждет его результата. Меньшее значение
+    priority обслуживается раньше, внутри одного приоритета - по порядку.
+    Очередь ограничена queue_size: при заполнении submit ждет. Ошибки,
+    для которых retry_on(err) истинно, повторяются с экспоненциальной
+    задержкой до max_retries раз.
+
+    Кроме общего ограничения rate можно задать свое для ключа (например,
+    сообщества) через set_rate: вызов с исчерпанным лимитом своего ключа
+    откладывается и не задерживает вызовы других ключей.
+    """
+
+    def __init__(
+            self,
+            rate: float = 20,
+            burst: float = None,
+            queue_size: int = 1000,
+            concurrency: int = 10,
+            max_retries: int = 5,
+            retry_delay: float = 1,
+            retry_on=None,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_on = retry_on or (lambda err: False)
+        self.submitted = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.deferred = 0
+        self.sent_by_key = defaultdict(int)
+        self.failed_by_key = defaultdict(int)
+        self.latencies = deque(maxlen=1000)
+        self._buckets = {}
+        self._seq = itertools.count()
+        self._queue = None
+        self._semaphore = None
+        self._worker = None
+        self._tasks = set()
+
+    async def start(self):
+        self._queue = asyncio.PriorityQueue(maxsize=self.queue_size)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        await self._queue.join()
+        # выполняемые и отложенные вызовы могут вернуться в очередь
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._queue.join()
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+
+    def set_rate(self, key, rate: float, burst: float = None):
+        """Отдельное ограничение частоты для вызовов с этим key"""
+        self._buckets[key] = TokenBucket(rate, burst)
+
+    def throttle(self, key=None):
+        """
+        Сбрасывает запас запросов после ошибки лимита: лимит ключа, если он
+        задан (остальные ключи не замедляются), иначе общий.
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self.bucket
+        bucket.drain()
+
+    async def submit(self, call, priority: int = PRIORITY_INTERACTIVE, key=None):
+        """Ставит корутинную функцию call в очередь и возвращает ее результат"""
+        future = asyncio.get_running_loop().create_future()
+        self.submitted += 1
+        await self._put(priority, call, future, 0, key)
+        return await future
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        stats = {
+            'queued': self.qsize(),
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'deferred': self.deferred,
+        }
+        if self._buckets:
+            stats['sent_by_key'] = dict(self.sent_by_key)
+            stats['failed_by_key'] = dict(self.failed_by_key)
+        if latencies:
+            stats['queue_latency_p50'] = latencies[len(latencies) // 2]
+            stats['queue_latency_p99'] = latencies[int(len(latencies) * 0.99)]
+            stats['queue_latency_max'] = latencies[-1]
+        return stats
+
+    async def _put(self, priority, call, future, attempt, key=None):
+        await self._queue.put((priority, next(self._seq), monotonic(), call, future, attempt, key))
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                future = item[4]
+                if future.done():
+                    continue
+                bucket = self._buckets.get(item[6])
+                if bucket is not None:
+                    wait = bucket.try_acquire()
+                    if wait:
+                        self._defer(item, wait)
+                        continue
+                await self.bucket.acquire()
+                await self._semaphore.acquire()
+                self.latencies.append(monotonic() - item[2])
+                task = asyncio.create_task(self._execute(*item))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            finally:
+                self._queue.task_done()
+
+    def _defer(self, item, wait):
+        self.deferred += 1
+        task = asyncio.create_task(self._requeue(item, wait))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _requeue(self, item, wait):
+        # тот же seq: внутри приоритета вызов сохраняет место в очереди
+        await asyncio.sleep(wait)
+        await self._queue.put(item)
+
+    async def _execute(self, priority, seq, enqueued_at, call, future, attempt, key):
+        try:
+            result = await call()
+        except Exception as err:
+            self._semaphore.release()
+            if self.retry_on(err) and attempt < self.max_retries:
+                self.retried += 1
+                self.throttle(key)
+                logger.warning(f'Повтор запроса после ошибки: {err}')
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                await self._put(priority, call, future, attempt + 1, key)
+                return
+            self.failed += 1
+            if key in self._buckets:
+                self.failed_by_key[key] += 1
+            if not future.done():
+                future.set_exception(err)
+        else:
+            self._semaphore.release()
+            self.sent += 1
+            if key in self._buckets:
+                self.sent_by_key[key] += 1
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,323 @@
+import asyncio
+import logging
+import redis
+import redis.asyncio
+
+from collections import OrderedDict
+from time import monotonic
+
+from metrics import REDIS_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+MODE_EXCLUSIVE = 'exclusive'
+MODE_SHARED = 'shared'
+
+
+def async_redis_from(redis_db: redis.Redis) -> redis.asyncio.Redis:
+    """Создает redis.asyncio клиента с теми же параметрами подключения, что и у синхронного"""
+    return redis.asyncio.Redis(**redis_db.connection_pool.connection_kwargs)
+
+
+class BaseStateStore:
+    """
+    Хранилище состояния пользователя и его профиля.
+
+    Раскладка ключей прежняя: состояние лежит в ключе {user_id},
+    имя и фамилия - в {user_id}_first_name и {user_id}_last_name.
+    state_prefix добавляется только к ключу состояния: так несколько
+    сообществ в одном Redis не делят состояния, но делят профили.
+    """
+
+    def __init__(self, redis_db, state_prefix: str = ''):
+        self.db = redis_db
+        self.state_prefix = state_prefix
+
+    def _keys(self, user_id):
+        return f'{self.state_prefix}{user_id}', f'{user_id}_first_name', f'{user_id}_last_name'
+
+    @staticmethod
+    def _decode(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def _parse(self, values):
+        state, first_name, last_name = (self._decode(value) for value in values)
+        profile = None
+        if first_name:
+            profile = {'first_name': first_name, 'last_name': last_name}
+        return state, profile
+
+    def _parse_profiles(self, user_ids, values):
+        profiles = {}
+        for user_id, first_name, last_name in zip(user_ids, values[::2], values[1::2]):
+            first_name = self._decode(first_name)
+            if first_name:
+                profiles[user_id] = {'first_name': first_name, 'last_name': self._decode(last_name)}
+        return profiles
+
+    @staticmethod
+    def _profile_keys(user_ids):
+        keys = []
+        for user_id in user_ids:
+            keys.extend((f'{user_id}_first_name', f'{user_id}_last_name'))
+        return keys
+
+    def _fill_pipeline(self, pipe, user_id, state, profile):
+        state_key, first_name_key, last_name_key = self._keys(user_id)
+        if state is not None:
+            pipe.set(state_key, state)
+        if profile:
+            pipe.set(first_name_key, profile.get('first_name') or '')
+            pipe.set(last_name_key, profile.get('last_name') or '')
+
+
+class AsyncStateStore(BaseStateStore):
+    """Неблокирующее хранилище на redis.asyncio: одно обращение на чтение и одно на запись"""
+
+    async def load(self, user_id):
+        """Возвращает (состояние, профиль) одним MGET"""
+        with REDIS_SECONDS.time(op='load'):
+            return self._parse(await self.db.mget(self._keys(user_id)))
+
+    async def get_profile(self, user_id):
+        __, profile = await self.load(user_id)
+        return profile
+
+    async def save(self, user_id, state=None, profile=None):
+        """Записывает состояние и профиль одним pipeline"""
+        with REDIS_SECONDS.time(op='save'):
+            async with self.db.pipeline(transaction=False) as pipe:
+                self._fill_pipeline(pipe, user_id, state, profile)
+                await pipe.execute()
+
+    async def load_profiles(self, user_ids):
+        """Профили нескольких пользователей одним MGET: {user_id: profile}"""
+        if not user_ids:
+            return {}
+        with REDIS_SECONDS.time(op='load_profiles'):
+            return self._parse_profiles(user_ids, await self.db.mget(self._profile_keys(user_ids)))
+
+    async def save_profiles(self, profiles: dict):
+        with REDIS_SECONDS.time(op='save_profiles'):
+            async with self.db.pipeline(transaction=False) as pipe:
+                for user_id, profile in profiles.items():
+                    self._fill_pipeline(pipe, user_id, None, profile)
+                await pipe.execute()
+
+
+class CachedStateStore:
+    """
+    Локальный кэш состояний поверх AsyncStateStore с тем же интерфейсом.
+
+    В режиме exclusive пользователя обрабатывает только этот процесс
+    (один long poll на сообщество или свой раздел Redis Streams):
+    состояние читается из Redis один раз, дальше load и save работают
+    с памятью, а изменения пишутся в Redis пачками (write-behind) -
+    раз в flush_interval секунд, при накоплении flush_batch изменений
+    и в close(). При падении процесса теряются изменения последних
+    flush_interval секунд.
+
+    В режиме shared пользователя могут обрабатывать несколько процессов:
+    состояние всегда читается из Redis и сразу записывается, в памяти
+    остаются только профили.
+
+    Пользователи, к которым не обращались ttl секунд, и самые старые
+    записи сверх max_size вытесняются из памяти; несохраненные изменения
+    остаются в очереди записи до сброса.
+    """
+
+    def __init__(
+            self,
+            store: AsyncStateStore,
+            mode: str = MODE_EXCLUSIVE,
+            max_size: int = 10000,
+            ttl: float = 600,
+            flush_interval: float = 1,
+            flush_batch: int = 500,
+    ):
+        if mode not in (MODE_EXCLUSIVE, MODE_SHARED):
+            raise ValueError(f'Неизвестный режим кэша состояний: {mode}')
+        self.store = store
+        self.db = store.db
+        self.mode = mode
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.evicted = 0
+        self._entries = OrderedDict()
+        self._dirty = {}
+        self._flushing = None
+        self._worker = None
+        self._stopped = asyncio.Event()
+        # периодический сброс и сброс по flush_batch не должны писать одновременно
+        self._flush_lock = asyncio.Lock()
+
+    async def start(self):
+        self._stopped.clear()
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает периодический сброс и записывает все несохраненные изменения"""
+        self._stopped.set()
+        # начатый сброс не отменяется, иначе его пачка потеряется
+        for task in (self._worker, self._flushing):
+            if task is not None:
+                await asyncio.gather(task, return_exceptions=True)
+        self._worker = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cached': len(self._entries),
+            'dirty': len(self._dirty),
+            'flushes': self.flushes,
+            'evicted': self.evicted,
+        }
+
+    async def load(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None and self.mode == MODE_EXCLUSIVE:
+            self.hits += 1
+            entry[2] = monotonic()
+            self._entries.move_to_end(user_id)
+            return entry[0], entry[1]
+        state, profile = self._dirty.get(user_id, (None, None))
+        if state is not None:
+            # вытеснен из памяти, но еще не записан в Redis
+            self.hits += 1
+            self._remember(user_id, state, profile)
+            return state, profile
+        self.misses += 1
+        if entry is not None:
+            # shared: состояние всегда из Redis, профиль уже известен
+            with REDIS_SECONDS.time(op='load_state'):
+                state = self.store._decode(await self.db.get(self.store._keys(user_id)[0]))
+            self._remember(user_id, state, entry[1])
+            return state, entry[1]
+        state, profile = await self.store.load(user_id)
+        self._remember(user_id, state, profile)
+        return state, profile
+
+    async def get_profile(self, user_id):
+        __, profile = await self.load(user_id)
+        return profile
+
+    async def save(self, user_id, state=None, profile=None):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._remember(user_id, entry[0] if state is None else state, profile or entry[1])
+        else:
+            self._remember(user_id, state, profile)
+        if self.mode == MODE_SHARED:
+            return await self.store.save(user_id, state, profile)
+        pending_state, pending_profile = self._dirty.get(user_id, (None, None))
+        self._dirty[user_id] = (
+            pending_state if state is None else state,
+            profile or pending_profile
+        )
+        if len(self._dirty) >= self.flush_batch and self._flushing is None:
+            self._flushing = asyncio.create_task(self._flush_logged())
+
+    async def load_profiles(self, user_ids):
+        return await self.store.load_profiles(user_ids)
+
+    async def save_profiles(self, profiles: dict):
+        for user_id, profile in profiles.items():
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry[1] = profile
+        await self.store.save_profiles(profiles)
+
+    async def flush(self):
+        """Записывает накопленные изменения одним pipeline; сбросы идут по одному"""
+        try:
+            async with self._flush_lock:
+                while self._dirty:
+                    dirty, self._dirty = self._dirty, {}
+                    try:
+                        with REDIS_SECONDS.time(op='flush'):
+                            async with self.db.pipeline(transaction=False) as pipe:
+                                for user_id, (state, profile) in dirty.items():
+                                    self.store._fill_pipeline(pipe, user_id, state, profile)
+                                await pipe.execute()
+                    except BaseException:
+                        # в том числе при отмене
+                        self._requeue(dirty)
+                        raise
+                    self.flushes += 1
+        finally:
+            if self._flushing is asyncio.current_task():
+                self._flushing = None
+
+    def _requeue(self, dirty):
+        """Возвращает несохраненную пачку в очередь, не затирая сохраненное после ее снимка"""
+        for user_id, (state, profile) in dirty.items():
+            newer_state, newer_profile = self._dirty.get(user_id, (None, None))
+            dirty[user_id] = (state if newer_state is None else newer_state, newer_profile or profile)
+        self._dirty = {**self._dirty, **dirty}
+
+    async def _flush_logged(self):
+        try:
+            await self.flush()
+        except Exception as err:
+            logger.exception(err)
+
+    def _remember(self, user_id, state, profile):
+        self._entries[user_id] = [state, profile, monotonic()]
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def _evict_idle(self):
+        deadline = monotonic() - self.ttl
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if entry[2] > deadline:
+                break
+            del self._entries[user_id]
+            self.evicted += 1
+
+    async def _run(self):
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._evict_idle()
+            await self._flush_logged()
+
+
+class SyncStateStore(BaseStateStore):
+    """Синхронный адаптер с тем же интерфейсом для longpoll.py"""
+
+    def load(self, user_id):
+        with REDIS_SECONDS.time(op='load'):
+            return self._parse(self.db.mget(self._keys(user_id)))
+
+    def get_profile(self, user_id):
+        __, profile = self.load(user_id)
+        return profile
+
+    def save(self, user_id, state=None, profile=None):
+        with REDIS_SECONDS.time(op='save'), self.db.pipeline(transaction=False) as pipe:
+            self._fill_pipeline(pipe, user_id, state, profile)
+            pipe.execute()
+
+    def load_profiles(self, user_ids):
+        if not user_ids:
+            return {}
+        return self._parse_profiles(user_ids, self.db.mget(self._profile_keys(user_ids)))
+
+    def save_profiles(self, profiles: dict):
+        with self.db.pipeline(transaction=False) as pipe:
+            for user_id, profile in profiles.items():
+                self._fill_pipeline(pipe, user_id, None, profile)
+            pipe.execute()
@@ -0,0 +1,241 @@
+"""
+Раздельные прием и обработка событий через Redis Streams.
+
+    python streams.py ingest                      - long poll пишет события в потоки
+    python streams.py worker --partition 0 -p 1   - обработчик своих разделов
+
+События message_new и message_event раскладываются по STREAM_PARTITIONS
+потокам по id пользователя, поэтому события одного пользователя всегда
+в одном потоке и обрабатываются по порядку. Каждый раздел должен читать один процесс-обработчик; событие
+подтверждается (XACK) только после успешного event_handler, а зависшие записи упавших
+обработчиков и записи, обработка которых завершилась ошибкой, забираются через XAUTOCLAIM.
+Событие, не обработанное за STREAM_MAX_DELIVERIES доставок, переносится в поток {раздел}:dead.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import redis.asyncio
+
+from time import monotonic
+from environs import Env
+from redis.exceptions import ResponseError
+
+import codec
+
+from async_longpoll import (
+    close_connect, connect_options, create_connect, create_redis, create_transports, handle_update,
+)
+from checkpoint import TsCheckpoint
+from events import EVENT_TYPES, event_user_id, parse_event
+from longpoll_client import LongPollClient
+from metrics import start_metrics_server
+
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_GROUP = 'handlers'
+
+
+def stream_key(group_id: int, partition: int):
+    return f'vk_updates:{group_id}:{partition}'
+
+
+def dead_letter_key(key: str):
+    return f'{key}:dead'
+
+
+async def append_updates(redis_db: redis.asyncio.Redis, group_id: int, partitions: int, events, maxlen: int):
+    """Добавляет события в потоки разделов одним pipeline"""
+    async with redis_db.pipeline(transaction=False) as pipe:
+        for event in events:
+            partition = event_user_id(event) % partitions
+            pipe.xadd(
+                stream_key(group_id, partition),
+                {'event': codec.dumps(event)},
+                maxlen=maxlen,
+                approximate=True
+            )
+        await pipe.execute()
+
+
+async def ingest():
+    """Long poll, который только складывает обрабатываемые события в потоки"""
+    env = Env()
+    env.read_env()
+    redis_db = create_redis(env)
+    token = env.str('TOKEN')
+    group_id = env.int('GROUP_ID')
+    partitions = env.int('STREAM_PARTITIONS', 4)
+    maxlen = env.int('STREAM_MAXLEN', 100000)
+    checkpoint = TsCheckpoint(redis_db, f'vk_longpoll:{group_id}:ts')
+    async with create_transports(env) as transports:
+        client = LongPollClient(
+            transports.api, token, group_id,
+            ts=await checkpoint.load(), wait=transports.wait, poll_session=transports.poll
+        )
+        async for events in client.listen():
+            events = [event for event in events if event['type'] in EVENT_TYPES]
+            if events:
+                await append_updates(redis_db, group_id, partitions, events, maxlen)
+            checkpoint.track(client.ts, [])
+
+
+class StreamWorker:
+    """
+    Обрабатывает один раздел: сначала свои неподтвержденные записи,
+    затем записи, забранные у упавших обработчиков, затем новые.
+
+    Запись, обработка которой завершилась ошибкой, не подтверждается и
+    через min_idle_ms снова забирается reclaim; после max_deliveries
+    доставок она переносится в поток dead_letter_key и подтверждается.
+    """
+
+    def __init__(
+            self,
+            connect,
+            group_id: int,
+            partition: int,
+            consumer: str,
+            count: int = 100,
+            block_ms: int = 5000,
+            min_idle_ms: int = 60000,
+            claim_interval: float = 30,
+            max_deliveries: int = 5,
+    ):
+        self.connect = connect
+        self.db = connect['redis_db']
+        self.key = stream_key(group_id, partition)
+        self.consumer = consumer
+        self.count = count
+        self.block_ms = block_ms
+        self.min_idle_ms = min_idle_ms
+        self.claim_interval = claim_interval
+        self.max_deliveries = max_deliveries
+        self.dead_key = dead_letter_key(self.key)
+        self.processed = 0
+        self.reclaimed = 0
+        self.failed = 0
+        self.dead = 0
+
+    async def ensure_group(self):
+        try:
+            await self.db.xgroup_create(self.key, CONSUMER_GROUP, id='0', mkstream=True)
+        except ResponseError as err:
+            if 'BUSYGROUP' not in str(err):
+                raise
+
+    async def run(self):
+        await self.ensure_group()
+        await self._read('0')
+        claimed_at = 0
+        while True:
+            if monotonic() - claimed_at > self.claim_interval:
+                await self.reclaim()
+                claimed_at = monotonic()
+            await self._read('>')
+
+    async def _read(self, last_id: str):
+        """'0' - свои неподтвержденные записи, '>' - новые"""
+        while True:
+            response = await self.db.xreadgroup(
+                CONSUMER_GROUP, self.consumer, {self.key: last_id},
+                count=self.count, block=self.block_ms if last_id == '>' else None
+            )
+            entries = [entry for __, stream_entries in response or [] for entry in stream_entries]
+            for entry_id, fields in entries:
+                await self.handle(entry_id, fields)
+            if last_id == '>' or not entries:
+                return
+            # неподтвержденные после ошибки записи остаются в истории, читаем дальше них
+            last_id = entries[-1][0]
+
+    async def reclaim(self):
+        start_id = '0-0'
+        while True:
+            start_id, entries, *__ = await self.db.xautoclaim(
+                self.key, CONSUMER_GROUP, self.consumer,
+                min_idle_time=self.min_idle_ms, start_id=start_id, count=self.count
+            )
+            self.reclaimed += len(entries)
+            for entry_id, fields in entries:
+                await self.handle(entry_id, fields)
+            if start_id in (b'0-0', '0-0'):
+                return
+
+    async def handle(self, entry_id, fields):
+        if fields:
+            try:
+                event = codec.loads(fields[b'event'])
+                if await self.connect['seen_events'].filter_new([event]):
+                    await handle_update(self.connect, parse_event(event))
+            except Exception as err:
+                logger.exception(err)
+                self.failed += 1
+                await self.give_up(entry_id, fields, err)
+                return
+        await self.db.xack(self.key, CONSUMER_GROUP, entry_id)
+        self.processed += 1
+
+    async def give_up(self, entry_id, fields, err):
+        """Переносит запись в dead_key, если ее доставляли max_deliveries раз, иначе оставляет для повтора"""
+        pending = await self.db.xpending_range(self.key, CONSUMER_GROUP, min=entry_id, max=entry_id, count=1)
+        if pending and pending[0]['times_delivered'] < self.max_deliveries:
+            return
+        async with self.db.pipeline(transaction=True) as pipe:
+            pipe.xadd(
+                self.dead_key,
+                {**fields, b'entry_id': entry_id, b'error': repr(err)},
+                maxlen=10000,
+                approximate=True
+            )
+            pipe.xack(self.key, CONSUMER_GROUP, entry_id)
+            await pipe.execute()
+        self.dead += 1
+        logger.error(f'{self.key} {entry_id}: не обработано за {self.max_deliveries} доставок, перенесено в очередь ошибок')
+
+
+async def work(partitions):
+    env = Env()
+    env.read_env()
+    redis_db = create_redis(env)
+    token = env.str('TOKEN')
+    group_id = env.int('GROUP_ID')
+    consumer_prefix = env.str('STREAM_CONSUMER', socket.gethostname())
+    async with create_transports(env) as transports:
+        connect = await create_connect(transports, token, redis_db, group_id, **connect_options(env))
+        metrics_port = env.int('METRICS_PORT', 0)
+        if metrics_port:
+            await start_metrics_server(metrics_port)
+        workers = [
+            StreamWorker(
+                connect, group_id, partition, f'{consumer_prefix}-{partition}',
+                max_deliveries=env.int('STREAM_MAX_DELIVERIES', 5)
+            )
+            for partition in partitions
+        ]
+        try:
+            await asyncio.gather(*(worker.run() for worker in workers))
+        finally:
+            await close_connect(connect)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=('ingest', 'worker'))
+    parser.add_argument(
+        '-p', '--partition', type=int, action='append', default=[],
+        help='номер раздела для обработчика, можно указать несколько'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.mode == 'ingest':
+        asyncio.run(ingest())
+    else:
+        partitions = args.partition or [int(os.environ.get('STREAM_PARTITION', 0))]
+        asyncio.run(work(partitions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import aiohttp
+
+
+def make_trace_config(stats: dict):
+    """TraceConfig, считающий запросы, новые и переиспользованные соединения"""
+
+    async def on_request_start(session, context, params):
+        stats['requests'] += 1
+
+    async def on_connection_create_end(session, context, params):
+        stats['connections_created'] += 1
+
+    async def on_connection_reuseconn(session, context, params):
+        stats['connections_reused'] += 1
+
+    async def on_dns_cache_hit(session, context, params):
+        stats['dns_cache_hits'] += 1
+
+    async def on_dns_cache_miss(session, context, params):
+        stats['dns_cache_misses'] += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+    trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+    return trace_config
+
+
+def new_stats():
+    return {
+        'requests': 0,
+        'connections_created': 0,
+        'connections_reused': 0,
+        'dns_cache_hits': 0,
+        'dns_cache_misses': 0,
+    }
+
+
+class Transports:
+    """
+    Две отдельно настроенные сессии aiohttp: poll для ожидания a_check
+    и api для вызовов методов api.vk.com.
+
+    Долгий запрос long poll не занимает соединения пула API, а таймаут
+    чтения poll-сессии привязан к параметру wait. Статистика соединений
+    каждой сессии доступна через stats().
+    """
+
+    def __init__(
+            self,
+            wait: int = 25,
+            api_limit: int = 100,
+            api_limit_per_host: int = 50,
+            api_timeout: float = 15,
+            poll_limit: int = 10,
+            dns_ttl: int = 300,
+            keepalive_timeout: float = 60,
+    ):
+        self.wait = wait
+        self.api_limit = api_limit
+        self.api_limit_per_host = api_limit_per_host
+        self.api_timeout = api_timeout
+        self.poll_limit = poll_limit
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.api = None
+        self.poll = None
+        self._stats = {'api': new_stats(), 'poll': new_stats()}
+
+    def create_api_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.api_limit,
+            limit_per_host=self.api_limit_per_host,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.api_timeout, connect=5),
+            trace_configs=[make_trace_config(self._stats['api'])],
+        )
+
+    def create_poll_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.poll_limit,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.wait + self.keepalive_timeout,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, connect=5, sock_read=self.wait + 10),
+            trace_configs=[make_trace_config(self._stats['poll'])],
+        )
+
+    def stats(self):
+        return {name: dict(stats) for name, stats in self._stats.items()}
+
+    async def __aenter__(self):
+        self.api = self.create_api_session()
+        self.poll = self.create_poll_session()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.api.close()
+        await self.poll.close()
@@ -0,0 +1,94 @@
+import os
+import aiohttp
+
+from functools import partial
+
+import codec
+
+from metrics import API_ERRORS, API_SECONDS
+from scheduler import PRIORITY_INTERACTIVE
+
+
+API_URL = os.environ.get('VK_API_URL', 'https://api.vk.com/method/')
+API_VERSION = '5.131'
+# 6 - слишком много запросов в секунду, 9 - flood control, 29 - лимит на метод
+RATE_LIMIT_ERRORS = {6, 9, 29}
+
+
+class VkApiError(Exception):
+    def __init__(self, error: dict):
+        self.code = error.get('error_code')
+        self.msg = error.get('error_msg')
+        super().__init__(f'[{self.code}] {self.msg}')
+
+
+def is_rate_limit_error(err: Exception):
+    return isinstance(err, VkApiError) and err.code in RATE_LIMIT_ERRORS
+
+
+def group_labels(group_id):
+    """Метка group_id для метрик, если сообщество известно"""
+    return {} if group_id is None else {'group_id': group_id}
+
+
+async def _post(session: aiohttp.ClientSession, token: str, method: str, data: dict, group_id=None):
+    data.update({'access_token': token, 'v': API_VERSION})
+    labels = group_labels(group_id)
+    try:
+        with API_SECONDS.time(method=method, **labels):
+            async with session.post(f'{API_URL}{method}', data=data) as res:
+                res.raise_for_status()
+                response = codec.loads(await res.read())
+    except aiohttp.ClientError:
+        API_ERRORS.inc(method=method, code='http', **labels)
+        raise
+    if 'error' in response:
+        API_ERRORS.inc(method=method, code=response['error'].get('error_code'), **labels)
+        raise VkApiError(response['error'])
+    return response
+
+
+async def request_method(
+        session: aiohttp.ClientSession, token: str, method: str, params: dict, /, *, group_id: int = None
+):
+    """
+    Вызывает метод API и возвращает поле response, ошибки API поднимаются как VkApiError.
+    group_id - метка метрик запроса.
+    """
+    data = {param: value for param, value in params.items() if value is not None}
+    response = await _post(session, token, method, data, group_id)
+    return response['response']
+
+
+async def execute_code(session: aiohttp.ClientSession, token: str, code: str, /, *, group_id: int = None):
+    """Вызывает execute и возвращает (response, execute_errors)"""
+    response = await _post(session, token, 'execute', {'code': code}, group_id)
+    return response['response'], response.get('execute_errors', [])
+
+
+async def submit(connect, call, priority: int = PRIORITY_INTERACTIVE):
+    scheduler = connect.get('scheduler')
+    if scheduler is None:
+        return await call()
+    return await scheduler.submit(call, priority=priority, key=connect.get('group_id'))
+
+
+async def call_method(
+        connect,
+        method: str,
+        params: dict,
+        /, *,
+        priority: int = PRIORITY_INTERACTIVE,
+        batch: bool = True,
+):
+    """
+    Вызов метода API с учетом connect['batcher'] (объединение в execute)
+    и connect['scheduler'] (очередь исходящих запросов), если они заданы.
+    """
+    batcher = connect.get('batcher')
+    if batch and batcher is not None:
+        return await batcher.call(method, params, priority=priority)
+    call = partial(
+        request_method, connect['session'], connect['token'], method, params, group_id=connect.get('group_id')
+    )
+    return await submit(connect, call, priority)